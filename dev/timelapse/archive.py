@@ -0,0 +1,174 @@
+import argparse
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from frame_manifest import FrameManifest
+from overlay_pirrigator_data import ImageFile, MIN_BRIGHTNESS
+from PIL import Image
+from typing import List, Tuple
+
+
+_YEAR_FORMAT = re.compile(r'\d\d\d\d$')
+_NAME_FORMAT = re.compile(r'img(\d\d)(\d\d)(\d\d)(\d\d)(\d\d).jpg$')
+
+# Archived frames are scaled down to this width, and kept for this long
+_WIDTH = 1280
+_QUALITY = 85
+_MAX_AGE = timedelta(days=400)
+
+
+class FrameArchive:
+  """
+  A compact long term store of source frames for summary timelapses. Each
+  day's frames are thinned to the brightest in each hour and scaled down
+  before being kept, under a directory per year with their names as the
+  camera gave them and their modification time set to the capture time,
+  so that 'ImageFile' reads the right date back from them
+  """
+  def __init__(self, directory: str, width: int = _WIDTH):
+    self._directory = directory
+    self._width = width
+    os.makedirs(directory, exist_ok=True)
+
+  def _path(self, taken: datetime) -> str:
+    return os.path.join(self._directory, f'{taken:%Y}', f'img{taken:%m%d%H%M%S}.jpg')
+
+  def add(self, path: str, taken: datetime) -> bool:
+    """
+    Archive the frame at 'path', taken at 'taken', unless it is already
+    archived. Returns whether it was added
+    """
+    out_path = self._path(taken)
+    if os.path.isfile(out_path):
+      return False
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with Image.open(path) as image:
+      height = round(image.height * self._width / image.width)
+      image.draft('RGB', (self._width, height))
+      image = image.convert('RGB')
+      if image.width > self._width:
+        image = image.resize((self._width, height), Image.BICUBIC, reducing_gap=2.0)
+
+      tmp_path = out_path + '.tmp'
+      image.save(tmp_path, format='JPEG', quality=_QUALITY)
+    os.utime(tmp_path, (taken.timestamp(), taken.timestamp()))
+    os.replace(tmp_path, out_path)
+    return True
+
+  def frames(self, start: datetime, end: datetime) -> List[Tuple[str, datetime]]:
+    """
+    Get the paths and capture times of the archived frames taken from
+    'start' up to but not including 'end', in date order. Only the year
+    directories overlapping the range are listed
+    """
+    frames = []
+    for year in range(start.year, end.year + 1):
+      directory = os.path.join(self._directory, str(year))
+      if not os.path.isdir(directory):
+        continue
+      for name in os.listdir(directory):
+        m = _NAME_FORMAT.match(name)
+        if m:
+          taken = datetime(year, *(int(s) for s in m.groups()))
+          if start <= taken < end:
+            frames.append((os.path.join(directory, name), taken))
+    return sorted(frames, key=lambda f: f[1])
+
+  def prune(self, max_age: timedelta = _MAX_AGE) -> int:
+    """
+    Delete frames captured more than 'max_age' ago, so the archive stays a
+    bounded size. Returns the number deleted
+    """
+    cutoff = time.time() - max_age.total_seconds()
+    removed = 0
+    for year in os.listdir(self._directory):
+      directory = os.path.join(self._directory, year)
+      if not (_YEAR_FORMAT.match(year) and os.path.isdir(directory)):
+        continue
+      for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.getmtime(path) < cutoff:
+          os.remove(path)
+          removed += 1
+      if not os.listdir(directory):
+        os.rmdir(directory)
+    return removed
+
+
+def brightest_per_hour(frames: List[Tuple[str, datetime]], brightness) -> List[Tuple[str, datetime]]:
+  """
+  Pick the brightest of 'frames' in each hour, leaving out hours with only
+  dark frames. 'brightness' gives the brightness of an 'ImageFile'
+  """
+  best = {}
+  for path, taken in frames:
+    level = brightness(ImageFile(path, taken))
+    hour = taken.replace(minute=0, second=0)
+    if level > MIN_BRIGHTNESS and (hour not in best or level > best[hour][0]):
+      best[hour] = (level, path, taken)
+  return [(path, taken) for _, path, taken in (best[h] for h in sorted(best))]
+
+
+def parse_command_line_args():
+  """
+  Parse the command line arguments. Returns the args object
+  """
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    'archive',
+    metavar='DIR',
+    type=str,
+    help='Archive directory'
+  )
+
+  parser.add_argument(
+    '--manifest',
+    action='store',
+    required=True,
+    help='Path to the manifest of the images to archive from'
+  )
+
+  parser.add_argument(
+    '--from',
+    dest='start',
+    action='store',
+    type=datetime.fromisoformat,
+    required=True,
+    help='Archive images taken from this date or time onwards'
+  )
+
+  parser.add_argument(
+    '--to',
+    dest='end',
+    action='store',
+    type=datetime.fromisoformat,
+    required=True,
+    help='Archive images taken before this date or time'
+  )
+
+  parser.add_argument(
+    '--max-age',
+    action='store',
+    type=int,
+    default=_MAX_AGE.days,
+    help='Delete archived images older than this many days'
+  )
+
+  return parser.parse_args()
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  args = parse_command_line_args()
+  manifest = FrameManifest(args.manifest)
+  archive = FrameArchive(args.archive)
+  frames = brightest_per_hour(manifest.frames(args.start, args.end), manifest.brightness)
+  added = sum(archive.add(path, taken) for path, taken in frames)
+  logging.info(f'Archived {added} of {len(frames)} images')
+  removed = archive.prune(timedelta(days=args.max_age))
+  if removed:
+    logging.info(f'Deleted {removed} archived images')
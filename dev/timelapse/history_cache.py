@@ -0,0 +1,144 @@
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+
+# Records newer than this may still be added to, so are never treated as cached
+_SETTLE = timedelta(minutes=10)
+
+# Records older than this are evicted. Every user of the cache evicts, so
+# this must cover the longest summary movie, which can reach back to any
+# frame still in the archive
+_MAX_AGE = timedelta(days=400)
+
+# Records are written and read this many at a time, so a long range is
+# never held in memory all at once
+_BATCH = 1000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+  series TEXT NOT NULL,
+  unix_time INTEGER NOT NULL,
+  data TEXT NOT NULL,
+  PRIMARY KEY (series, unix_time)
+);
+CREATE TABLE IF NOT EXISTS ranges (
+  series TEXT NOT NULL,
+  start INTEGER NOT NULL,
+  end INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ranges_series ON ranges (series, start);
+'''
+
+
+class HistoryCache:
+  """
+  A local SQLite cache of Pirrigator history records. Each named series
+  remembers which time ranges it holds all the records for, so only the
+  parts of a request not already covered need to be fetched
+  """
+  def __init__(self, path: str, max_age: timedelta = _MAX_AGE, settle: timedelta = _SETTLE):
+    self._settle = settle.total_seconds()
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    self._db.executescript(_SCHEMA)
+    self.evict(max_age)
+
+  def close(self):
+    self._db.close()
+
+  def evict(self, max_age: timedelta):
+    """
+    Forget all records older than 'max_age'
+    """
+    cutoff = int(time.time() - max_age.total_seconds())
+    with self._lock, self._db:
+      self._db.execute('DELETE FROM records WHERE unix_time < ?', (cutoff,))
+      self._db.execute('DELETE FROM ranges WHERE end < ?', (cutoff,))
+      self._db.execute('UPDATE ranges SET start = ? WHERE start < ?', (cutoff, cutoff))
+
+  def _missing(self, series: str, start: int, end: int) -> List[Tuple[int, int]]:
+    """
+    Find the sub-ranges of 'start'..'end' not covered for 'series'
+    """
+    covered = self._db.execute(
+      'SELECT start, end FROM ranges WHERE series = ? AND end >= ? AND start <= ? ORDER BY start',
+      (series, start, end)
+    ).fetchall()
+
+    missing = []
+    t = start
+    for s, e in covered:
+      if s > t:
+        missing.append((t, s))
+      t = max(t, e)
+    if t < end:
+      missing.append((t, end))
+    return missing
+
+  def _add(self, series: str, records: Iterable[dict]):
+    """
+    Store 'records'
+    """
+    self._db.executemany(
+      'INSERT OR REPLACE INTO records (series, unix_time, data) VALUES (?, ?, ?)',
+      ((series, r['unix_time'], json.dumps(r)) for r in records)
+    )
+
+  def _cover(self, series: str, start: int, end: int):
+    """
+    Mark 'start'..'end' as covered, merging it with any overlapping ranges
+    """
+    covered_until = int(time.time() - self._settle)
+    end = min(end, covered_until)
+    if start >= end:
+      return
+
+    s, e = self._db.execute(
+      'SELECT MIN(start), MAX(end) FROM ranges WHERE series = ? AND end >= ? AND start <= ?',
+      (series, start, end)
+    ).fetchone()
+    self._db.execute('DELETE FROM ranges WHERE series = ? AND end >= ? AND start <= ?', (series, start, end))
+    self._db.execute(
+      'INSERT INTO ranges (series, start, end) VALUES (?, ?, ?)',
+      (series, start if s is None else min(s, start), end if e is None else max(e, end))
+    )
+
+  def get(self, series: str, start: int, end: int, fetch: Callable[[int, int], Iterable[dict]]) -> Iterator[dict]:
+    """
+    Yields the records for 'series' between timestamps 'start' and 'end'
+    in time order, calling 'fetch(start, end)' for any sub-ranges not
+    already cached
+    """
+    with self._lock:
+      missing = self._missing(series, start, end)
+
+    for s, e in missing:
+      logging.debug(f'Cache miss for {series} {s}..{e}')
+      records = iter(fetch(s, e))
+      while True:
+        batch = list(itertools.islice(records, _BATCH))
+        if not batch:
+          break
+        with self._lock, self._db:
+          self._add(series, batch)
+      with self._lock, self._db:
+        self._cover(series, s, e)
+
+    with self._lock:
+      rows = self._db.execute(
+        'SELECT data FROM records WHERE series = ? AND unix_time >= ? AND unix_time <= ? ORDER BY unix_time',
+        (series, start, end)
+      )
+    while True:
+      with self._lock:
+        batch = rows.fetchmany(_BATCH)
+      if not batch:
+        return
+      for data, in batch:
+        yield json.loads(data)
@@ -1,19 +1,34 @@
 import argparse
+import cProfile
+import itertools
+import json
 import os
 import logging
-import re
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from PIL import Image
-from pirrigator_client import PirrigatorClient
+from multiprocessing import Pool
+from PIL import Image, ImageStat
+from frame_manifest import FrameManifest, capture_time, OVERLAID, ENCODED
+from history_cache import HistoryCache
+from pirrigator_client import PirrigatorClient, NEAREST, PREVIOUS, LINEAR
+from run_report import RunReport, frame_stats
 from text_writer import *
-from typing import Iterable
+from thumbnails import SpriteSheets, thumbnail, draft_thumbnail
+from typing import Iterable, List, Tuple
+from video_writer import VideoWriter, RENDITIONS
 
-logging.basicConfig(level=logging.INFO)
 
+MIN_BRIGHTNESS = 0.04
+FRAME_DURATION = 0.25
+_BRIGHTNESS_SCALE = 8
+_FINGERPRINT_SIZE = (16, 16)
 
-_PATH_FORMAT = re.compile(r'img(\d\d)(\d\d)(\d\d)(\d\d)(\d\d).jpg')
-_MIN_BRIGHTNESS = 0.04
+# Consecutive frames are merged if their fingerprints differ in no more than
+# the given number of bits, their brightness by no more than this, and no
+# more than this many frames are merged into one
+_SIMILAR_BRIGHTNESS = 0.02
+_SIMILAR_MAX_RUN = 6
 
 _WEATHER_X1 = 0.65
 _WEATHER_X2 = 0.83
@@ -33,44 +48,124 @@ _MOISTURE_OVERLAYS = {
 
 
 class ImageFile:
-  def __init__(self, path: str):
+  """
+  A timelapse image file. The timestamp comes from the file name, or from
+  'taken' if already known; the image itself is only decoded when it is
+  needed and is released again once the composite has been written
+  """
+  def __init__(self, path: str, taken: datetime = None):
     assert os.path.isfile(path), f"{path} is not a file"
 
-    m = _PATH_FORMAT.match(os.path.basename(path))
-    assert m, f"{path} is not in the expected filename format"
-    month, day, hour, minute, second = (int(s) for s in m.groups())
-
-    self._datetime = datetime(datetime.today().year, month, day, hour, minute, second)
-    self._image = Image.open(path)
+    self._datetime = taken or \
+      capture_time(os.path.basename(path), datetime.fromtimestamp(os.path.getmtime(path)))
+    self._path = path
+    self._image = None
+    self._composite = None
+    self._brightness = None
+    self._fingerprint = None
     self._out_path = path.replace('jpg', 'png')
 
+  def path(self) -> str:
+    """
+    The source file path for this image
+    """
+    return self._path
+
+  def out_path(self) -> str:
+    """
+    The path the composite image is saved to
+    """
+    return self._out_path
+
+  def rendered(self) -> bool:
+    """
+    Whether a composite image has already been saved for this image
+    """
+    return os.path.isfile(self._out_path) and \
+      os.path.getmtime(self._out_path) >= os.path.getmtime(self._path)
+
+  def load_rendered(self) -> Image:
+    """
+    Load the previously saved composite image
+    """
+    with Image.open(self._out_path) as composite:
+      composite.load()
+      self._composite = composite
+    return self._composite
+
   def datetime(self) -> datetime:
     """
     The `datetime` for this image
     """
     return self._datetime
 
+  def image(self) -> Image:
+    """
+    The decoded image, loading it from disk on first use
+    """
+    if self._image is None:
+      with Image.open(self._path) as image:
+        image.load()
+        self._image = image
+    return self._image
+
+  def _measure(self):
+    """
+    Measure the brightness and fingerprint together from a single reduced
+    scale greyscale decode, so both are cheap to compute
+    """
+    with Image.open(self._path) as image:
+      image.draft('L', (image.width // _BRIGHTNESS_SCALE, image.height // _BRIGHTNESS_SCALE))
+      grey = image.convert('L')
+
+    self._brightness = ImageStat.Stat(grey).mean[0] / 255.0
+
+    # A difference hash: one bit per horizontally adjacent pair of pixels
+    # in a tiny version of the image, set where brightness increases
+    w, h = _FINGERPRINT_SIZE
+    pixels = grey.resize((w + 1, h), Image.BOX).tobytes()
+    bits = 0
+    for y in range(h):
+      row = pixels[y * (w + 1):(y + 1) * (w + 1)]
+      for x in range(w):
+        bits = (bits << 1) | (row[x + 1] > row[x])
+    self._fingerprint = f'{bits:0{w * h // 4}x}'
+
   def brightness(self) -> float:
     """
     Get an overall measure of brightness for this image, where
     0.0 = completely dark and 1.0 = completely white
     """
-    histogram = self._image.convert('L').histogram()
-    total = sum(histogram)
-    weighted = sum(i * j for i,j in enumerate(histogram)) / 255.0
-    return weighted / total
+    if self._brightness is None:
+      self._measure()
+    return self._brightness
+
+  def fingerprint(self) -> str:
+    """
+    Get a perceptual hash of this image as a hex string, which differs in
+    few bits between images that look alike. See fingerprint_distance()
+    """
+    if self._fingerprint is None:
+      self._measure()
+    return self._fingerprint
 
   @contextmanager
   def overlay(self):
     """
     Overlay the data in 'data' on the image
     """
-    writer = TextWriter(self._image)
+    writer = TextWriter(self.image())
     yield writer
     self._composite = writer.composite()
     
     return self
 
+  def composite(self) -> Image:
+    """
+    The composite image
+    """
+    return self._composite
+
   def show(self):
     """
     Show the composite image
@@ -79,19 +174,150 @@ class ImageFile:
 
   def save(self) -> str:
     """
-    Write the composite image, returning the output file path
+    Write the composite image, returning the output file path. The
+    decoded image and composite are released afterwards
     """
-    self._composite.save(self._out_path)
+    # Write to a temporary file first so nothing else ever sees a partial image
+    tmp_path = self._out_path + '.tmp'
+    self._composite.save(tmp_path, format='PNG')
+    os.replace(tmp_path, self._out_path)
+    self.release()
     return self._out_path
 
+  def release(self):
+    """
+    Drop the decoded image and composite so their memory can be reclaimed
+    """
+    self._image = None
+    self._composite = None
 
-def write_index_file(path: str, paths: Iterable[str]):
+
+class BrightnessCache:
   """
-  Write an ffmpeg concat index file to 'path' for 'images'
+  Remembers the brightness and fingerprint of each image file between
+  runs, keyed by file name and invalidated if the file size or
+  modification time changes
   """
+  def __init__(self, path: str = None):
+    self._path = path
+    self._entries = {}
+    if path and os.path.isfile(path):
+      with open(path, 'rt') as f:
+        self._entries = json.load(f)
+    self._seen = {}
+
+  def _entry(self, image: ImageFile) -> list:
+    name = os.path.basename(image.path())
+    st = os.stat(image.path())
+    entry = self._entries.get(name)
+    if entry is None or entry[:2] != [st.st_mtime, st.st_size] or len(entry) < 4:
+      entry = [st.st_mtime, st.st_size, image.brightness(), image.fingerprint()]
+      self._entries[name] = entry
+    self._seen[name] = entry
+    return entry
+
+  def brightness(self, image: ImageFile) -> float:
+    """
+    Get the brightness of 'image', measuring it only if not already known
+    """
+    return self._entry(image)[2]
+
+  def fingerprint(self, image: ImageFile) -> str:
+    """
+    Get the fingerprint of 'image', measuring it only if not already known
+    """
+    return self._entry(image)[3]
+
+  def save(self):
+    """
+    Write the entries for all the images seen in this run back to disk
+    """
+    if self._path:
+      with open(self._path, 'wt') as f:
+        json.dump(self._seen, f)
+
+
+def fingerprint_distance(a: str, b: str) -> int:
+  """
+  The number of bits which differ between two image fingerprints
+  """
+  return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+class SimilarFrames:
+  """
+  Finds runs of consecutive near-identical frames, such as on a still
+  overcast day, so each run can be overlaid and encoded once and shown
+  for as long as the whole run would have been. Frames are compared with
+  the first frame of the current run rather than the previous frame so
+  that slow changes still start a new run. 'measures' is anything with
+  brightness() and fingerprint() methods taking an ImageFile, such as a
+  BrightnessCache or FrameManifest
+  """
+  def __init__(self, max_distance: int, measures, max_run: int = _SIMILAR_MAX_RUN):
+    self._max_distance = max_distance
+    self._measures = measures
+    self._max_run = max_run
+    self._first = None
+    self.run = 0
+
+  def add(self, image: ImageFile) -> bool:
+    """
+    Add the next frame. Returns True if it starts a new run, or False if
+    it has been merged into the current one. Adding the first frame of the
+    current run again, as when it is retried, leaves the run as it is
+    """
+    if self._first is not None and image.path() == self._first.path():
+      return True
+    if self._first is not None and self.run < self._max_run and \
+       abs(self._measures.brightness(image) - self._measures.brightness(self._first)) <= _SIMILAR_BRIGHTNESS and \
+       fingerprint_distance(self._measures.fingerprint(image), self._measures.fingerprint(self._first)) <= self._max_distance:
+      self.run += 1
+      return False
+
+    self._first = image
+    self.run = 1
+    return True
+
+  def first(self) -> ImageFile:
+    """
+    The first frame of the current run
+    """
+    return self._first
+
+
+def merge_similar(images: List[ImageFile], similar: SimilarFrames,
+                  manifest: FrameManifest = None) -> Tuple[List[ImageFile], List[int]]:
+  """
+  Merge runs of similar frames in 'images', returning the frames kept and
+  the number of frame times each is shown for. These are recorded in the
+  manifest if given, with zero for each frame merged into another. A run
+  carried over from frames given to 'similar' earlier is continued
+  """
+  kept, slots = [], []
+  for image in images:
+    if similar.add(image):
+      kept.append(image)
+      slots.append(1)
+    elif kept:
+      slots[-1] += 1
+    if manifest:
+      manifest.set_slots(similar.first().path(), similar.run)
+      if image.path() != similar.first().path():
+        manifest.set_slots(image.path(), 0)
+  return kept, slots
+
+
+def write_index_file(path: str, paths: Iterable[str], durations: Iterable[float] = None):
+  """
+  Write an ffmpeg concat index file to 'path' for 'images', each shown for
+  the matching entry of 'durations' or for one frame if not given
+  """
+  if durations is None:
+    durations = itertools.repeat(FRAME_DURATION)
   with open(path, 'wt') as f:
-    for path in paths:
-      f.write(f"file '{path}'\nduration 0.25\n")
+    for path, duration in zip(paths, durations):
+      f.write(f"file '{path}'\nduration {duration}\n")
 
 
 def parse_command_line_args():
@@ -104,8 +330,8 @@ def parse_command_line_args():
     'images',
     metavar='PATH',
     type=str,
-    nargs='+',
-    help='Images to process'
+    nargs='*',
+    help='Images to process, unless selected from the manifest with --from and --to'
   )
 
   parser.add_argument(
@@ -121,14 +347,121 @@ def parse_command_line_args():
     help='Base URL for Pirrigator API'
   )
 
+  parser.add_argument(
+    '--cache',
+    action='store',
+    help='Path to a local database to cache Pirrigator history in'
+  )
+
   parser.add_argument(
     '--index',
     action='store',
-    default='/tmp/index.txt',
-    help='Path to ffmpeg concat index file for image sequence'
+    help='Path to write an ffmpeg concat index file for the image sequence to'
   )
 
-  return parser.parse_args()
+  parser.add_argument(
+    '--video',
+    action='store',
+    help='Encode the images straight into this video file with ffmpeg '
+         'instead of writing image files and an index'
+  )
+
+  parser.add_argument(
+    '--thumbnails',
+    action='store',
+    metavar='PREFIX',
+    help='Write a poster image, thumbnail sprite sheets and a WebVTT thumbnail '
+         'track for the movie to files starting with this path'
+  )
+
+  parser.add_argument(
+    '--renditions',
+    action='store_true',
+    help='With --video, also encode smaller renditions of the video alongside it '
+         'from the same frames'
+  )
+
+  parser.add_argument(
+    '--brightness-cache',
+    action='store',
+    help='Path to a file to remember image brightness in between runs'
+  )
+
+  parser.add_argument(
+    '--manifest',
+    action='store',
+    help='Path to a manifest recording how far each image has been processed, '
+         'which should be in the same directory as the images. Used instead '
+         'of --brightness-cache and --reuse-rendered'
+  )
+
+  parser.add_argument(
+    '--from',
+    dest='start',
+    action='store',
+    type=datetime.fromisoformat,
+    help='Process the images in the manifest taken from this date or time onwards'
+  )
+
+  parser.add_argument(
+    '--to',
+    dest='end',
+    action='store',
+    type=datetime.fromisoformat,
+    help='Process the images in the manifest taken before this date or time'
+  )
+
+  parser.add_argument(
+    '--merge-similar',
+    action='store',
+    type=int,
+    metavar='BITS',
+    help='Merge runs of consecutive frames whose fingerprints differ in no more than '
+         'this many bits, overlaying one frame and showing it for the whole run'
+  )
+
+  parser.add_argument(
+    '--sampling',
+    action='store',
+    choices=[NEAREST, PREVIOUS, LINEAR],
+    default=NEAREST,
+    help='How to sample the Pirrigator data at each image time'
+  )
+
+  parser.add_argument(
+    '--reuse-rendered',
+    action='store_true',
+    help='Use composite images already saved alongside the images rather than '
+         'rendering them again'
+  )
+
+  parser.add_argument(
+    '--report',
+    action='store',
+    help='Write a JSON report of the time taken by each stage and image to this file'
+  )
+
+  parser.add_argument(
+    '--profile',
+    action='store',
+    help='Write cProfile statistics for the main process to this file'
+  )
+
+  parser.add_argument(
+    '--workers',
+    action='store',
+    type=int,
+    default=1,
+    help='Number of processes to render images with'
+  )
+
+  args = parser.parse_args()
+  if args.start or args.end:
+    if not (args.manifest and args.start and args.end):
+      parser.error('--from and --to need --manifest and must be given together')
+  elif not args.images:
+    parser.error('no images given')
+  return args
 
 
 class OverlayData:
@@ -136,13 +469,32 @@ class OverlayData:
   Holds all the time series data and uses this to draw over each
   image supplied
   """
-  def __init__(self, client: PirrigatorClient, start_time: datetime, end_time: datetime):
-    self._weather = client.weather_history(start_time, end_time)
-    self._moisture = { 
-      sensor: client.moisture_history(sensor, start_time, end_time) 
-      for sensor in _MOISTURE_OVERLAYS.keys()
+  def __init__(self, client: PirrigatorClient, start_time: datetime, end_time: datetime,
+               times: Iterable[datetime] = (), sampling: str = NEAREST):
+    self._sampling = sampling
+    history = client.history(start_time, end_time, sensors=list(_MOISTURE_OVERLAYS.keys()), zones=[])
+    self._weather = history.weather
+    self._moisture = history.moisture
+
+    # Sample the series at all the known frame times in one pass
+    times = list(times)
+    moisture = { sensor: series.sample(times, sampling) for sensor, series in self._moisture.items() }
+    self._frames = {
+      t: (weather, { sensor: records[i] for sensor, records in moisture.items() })
+      for i, (t, weather) in enumerate(zip(times, self._weather.sample(times, sampling)))
     }
 
+  def _records_at(self, t: datetime):
+    """
+    Get the weather record and moisture records by sensor for time 't'
+    """
+    if t in self._frames:
+      return self._frames[t]
+    return (
+      self._weather.sample([t], self._sampling)[0],
+      { sensor: series.sample([t], self._sampling)[0] for sensor, series in self._moisture.items() }
+    )
+
   def draw(self, image: Image):
     """
     Overlay the data for 'image'
@@ -150,29 +502,230 @@ class OverlayData:
     t = image.datetime()
     logging.info(f'Processing {t}...')
 
+    weather, moisture = self._records_at(t)
+
     with image.overlay() as writer:
       for overlay in _WEATHER_OVERLAYS:
-        overlay.draw(writer, self._weather.at(t))
+        overlay.draw(writer, weather)
 
       for sensor, overlay in _MOISTURE_OVERLAYS.items():
-        overlay.draw(writer, self._moisture[sensor].at(t))
+        overlay.draw(writer, moisture[sensor])
 
     return image
 
 
-if __name__ == "__main__":
-  args = parse_command_line_args()
-  images = [ImageFile(i) for i in args.images]
-  start_time = min(i.datetime() for i in images)
-  end_time = max(i.datetime() for i in images) + timedelta(minutes=10)
+# The OverlayData shared by all the images rendered in this process, and
+# whether to make a thumbnail of each
+_overlay_data = None
+_thumbnails = False
 
-  client = PirrigatorClient(args.pirrigator)
-  data = OverlayData(client, start_time, end_time)
+
+def _init_renderer(data: OverlayData, thumbnails: bool):
+  global _overlay_data, _thumbnails
+  _overlay_data = data
+  _thumbnails = thumbnails
+  default_renderer().preload(
+    label
+    for overlay in _WEATHER_OVERLAYS + list(_MOISTURE_OVERLAYS.values())
+    for label in overlay.labels()
+  )
+
+
+def _render(job: Tuple[str, bool]) -> Tuple[str, dict, Image]:
+  """
+  Overlay and save the image at 'path', unless 'reuse' is set in which
+  case it has been saved already. Returns the output file path, the
+  statistics for the image and its thumbnail if wanted
+  """
+  path, reuse = job
+  tile = None
+  with frame_stats(os.path.basename(path)) as stats:
+    image = ImageFile(path)
+    if reuse:
+      stats['reused'] = True
+      out_path = image.out_path()
+      if _thumbnails:
+        # From the composite, so the tile shows the data like all the others
+        tile = draft_thumbnail(out_path)
+    else:
+      try:
+        composite = _overlay_data.draw(image).composite()
+        if _thumbnails:
+          tile = thumbnail(composite)
+        out_path = image.save()
+      finally:
+        image.release()
+      stats['bytes'] = os.path.getsize(out_path)
+  return out_path, stats, tile
+
+
+def render_frame(job: Tuple[str, bool]) -> Tuple[Image, dict, Image]:
+  """
+  Overlay the image at 'path', or load the saved composite if 'reuse' is
+  set. Returns the composite image, the statistics for the image and its
+  thumbnail if wanted
+  """
+  path, reuse = job
+  with frame_stats(os.path.basename(path)) as stats:
+    image = ImageFile(path)
+    try:
+      if reuse:
+        stats['reused'] = True
+        frame = image.load_rendered()
+      else:
+        frame = _overlay_data.draw(image).composite()
+    finally:
+      image.release()
+    tile = thumbnail(frame) if _thumbnails else None
+  return frame, stats, tile
+
+
+def _bounded_imap(pool: Pool, in_flight: int):
+  """
+  Get a function like pool.imap which keeps no more than 'in_flight' jobs
+  queued or running, so results are never produced much faster than they
+  are consumed
+  """
+  def imap(func, jobs):
+    pending = deque()
+    for job in jobs:
+      if len(pending) >= in_flight:
+        yield pending.popleft().get()
+      pending.append(pool.apply_async(func, (job,)))
+    while pending:
+      yield pending.popleft().get()
+  return imap
+
+
+@contextmanager
+def image_renderer(data: OverlayData, workers: int, thumbnails: bool = False, in_flight: int = None):
+  """
+  Yields a function which maps a render function over (image path, reuse)
+  jobs, giving results in the same order, using a pool of 'workers'
+  processes if more than one. The OverlayData is handed to each worker
+  process once at startup. If 'thumbnails' is set, each result includes
+  a thumbnail made while the frame is decoded. Set 'in_flight' to limit
+  the jobs handed to the pool at once when the results are whole images
+  """
+  if workers > 1:
+    with Pool(workers, initializer=_init_renderer, initargs=(data, thumbnails)) as pool:
+      yield _bounded_imap(pool, in_flight) if in_flight else pool.imap
+  else:
+    _init_renderer(data, thumbnails)
+    yield map
+
+
+def run(args, report: RunReport):
+  """
+  Process the images given on the command line
+  """
+  manifest = FrameManifest(args.manifest) if args.manifest else None
+
+  # Drop images too dark to be worth including before any real work is done
+  with report.stage('brightness'):
+    cache = manifest or BrightnessCache(args.brightness_cache)
+    if args.start:
+      candidates = [ImageFile(p, t) for p, t in manifest.frames(args.start, args.end)]
+    else:
+      candidates = [ImageFile(p) for p in args.images]
+    images = sorted((i for i in candidates if cache.brightness(i) > MIN_BRIGHTNESS), key=ImageFile.datetime)
+    cache.save()
+  report.count('images', len(candidates))
+  report.count('skipped_dark', len(candidates) - len(images))
+
+  if not images:
+    logging.warning('No images bright enough to process')
+    if args.index:
+      write_index_file(args.index, [])
+    return
+
+  slots = [1] * len(images)
+  if args.merge_similar is not None:
+    with report.stage('similarity'):
+      kept, slots = merge_similar(images, SimilarFrames(args.merge_similar, cache), manifest)
+    report.count('merged_similar', len(images) - len(kept))
+    images = kept
+
+  start_time = images[0].datetime()
+  end_time = images[-1].datetime() + timedelta(minutes=10)
+
+  with report.stage('fetch'):
+    history_cache = HistoryCache(args.cache) if args.cache else None
+    client = PirrigatorClient(args.pirrigator, cache=history_cache, on_request=report.add_request)
+    data = OverlayData(client, start_time, end_time, (i.datetime() for i in images), args.sampling)
+
+  if manifest:
+    jobs = [(i.path(), manifest.rendered(i)) for i in images]
+  else:
+    jobs = [(i.path(), args.reuse_rendered and i.rendered()) for i in images]
 
   if args.show:
     data.draw(images[0]).show()
+    return
+
+  sprites = SpriteSheets(args.thumbnails, FRAME_DURATION) if args.thumbnails else None
+  paths = []
+
+  if args.video:
+    with report.stage('render'), \
+         image_renderer(data, args.workers, sprites is not None, 2 * args.workers) as render, \
+         VideoWriter(args.video, 1 / FRAME_DURATION, renditions=RENDITIONS if args.renditions else ()) as video:
+      for n, (frame, stats, tile) in enumerate(render(render_frame, jobs)):
+        for _ in range(slots[n]):
+          video.write(frame)
+        report.add_frame(stats)
+        if sprites:
+          sprites.add(tile, slots[n])
+          if n == len(jobs) // 2:
+            sprites.poster(frame)
+    paths = video.paths()
+
+    if manifest:
+      for path, _ in jobs:
+        manifest.mark(path, ENCODED)
 
   else:
-    images_in_date_order = sorted(images, key=ImageFile.datetime)
-    composite_images = (data.draw(i).save() for i in images if i.brightness() > _MIN_BRIGHTNESS)
-    write_index_file(args.index, composite_images)
+    def rendered(results):
+      for n, ((source, reused), (path, stats, tile)) in enumerate(zip(jobs, results)):
+        report.add_frame(stats)
+        if manifest and not reused:
+          manifest.mark(source, OVERLAID)
+        if sprites:
+          sprites.add(tile, slots[n])
+          if n == len(jobs) // 2:
+            with Image.open(path) as poster:
+              sprites.poster(poster)
+        yield path
+
+    with report.stage('render'), \
+         image_renderer(data, args.workers, sprites is not None) as render:
+      composites = rendered(render(_render, jobs))
+      if args.index:
+        write_index_file(args.index, composites, (n * FRAME_DURATION for n in slots))
+      else:
+        for _ in composites:
+          pass
+
+  if sprites:
+    sprites.close()
+    paths += sprites.paths
+  for path in paths:
+    report.count('bytes_written', os.path.getsize(path))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  args = parse_command_line_args()
+  report = RunReport()
+  profile = cProfile.Profile() if args.profile else None
+
+  if profile:
+    profile.enable()
+  try:
+    run(args, report)
+  finally:
+    if profile:
+      profile.disable()
+      profile.dump_stats(args.profile)
+    if args.report:
+      report.write(args.report, 'overlay')
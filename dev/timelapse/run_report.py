@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _percentile(s: list, p: float) -> float:
+  return s[min(int(len(s) * p / 100), len(s) - 1)] if s else 0.0
+
+
+@contextmanager
+def frame_stats(name: str):
+  """
+  Yields a dict which is filled in with the wall and CPU time taken by the
+  body for the frame 'name'. Anything else put in the dict is kept
+  """
+  stats = { 'frame': name }
+  wall, cpu = time.perf_counter(), time.process_time()
+  try:
+    yield stats
+  finally:
+    stats['wall_s'] = time.perf_counter() - wall
+    stats['cpu_s'] = time.process_time() - cpu
+
+
+class RunReport:
+  """
+  Collects timings for a run: wall and CPU time for each stage and frame,
+  the duration of each HTTP request, counters and the bytes written
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._started = time.time()
+    self._stages = {}
+    self._frames = []
+    self._requests = []
+    self._counters = {}
+
+  @contextmanager
+  def stage(self, name: str):
+    """
+    Time the body as stage 'name'. Repeated stages are added together
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+      yield
+    finally:
+      wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+      with self._lock:
+        stage = self._stages.setdefault(name, { 'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0 })
+        stage['count'] += 1
+        stage['wall_s'] += wall
+        stage['cpu_s'] += cpu
+
+  def add_frame(self, stats: dict):
+    with self._lock:
+      self._frames.append(stats)
+    self.count('bytes_written', stats.get('bytes', 0))
+
+  def add_request(self, url: str, seconds: float, size: int):
+    with self._lock:
+      self._requests.append({ 'url': url, 'seconds': seconds, 'bytes': size })
+
+  def count(self, name: str, n: int = 1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + n
+
+  def to_dict(self) -> dict:
+    with self._lock:
+      walls = sorted(f['wall_s'] for f in self._frames)
+      return {
+        'started': self._started,
+        'elapsed_s': time.time() - self._started,
+        'stages': dict(self._stages),
+        'counters': dict(self._counters),
+        'frame_summary': {
+          'count': len(walls),
+          'wall_s': sum(walls),
+          'cpu_s': sum(f['cpu_s'] for f in self._frames),
+          'p50_wall_s': _percentile(walls, 50),
+          'p95_wall_s': _percentile(walls, 95),
+          'max_wall_s': walls[-1] if walls else 0.0
+        },
+        'frames': list(self._frames),
+        'requests': list(self._requests)
+      }
+
+  def write(self, path: str, section: str):
+    """
+    Write the report into 'section' of the JSON file at 'path', keeping
+    any other sections already there so several steps can share one file
+    """
+    report = {}
+    if os.path.isfile(path):
+      with open(path, 'rt') as f:
+        try:
+          report = json.load(f)
+        except ValueError:
+          pass
+    report[section] = self.to_dict()
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wt') as f:
+      json.dump(report, f, indent=1)
+    os.replace(tmp_path, path)
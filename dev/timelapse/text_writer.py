@@ -1,25 +1,150 @@
+from collections import OrderedDict
 from datetime import datetime
 from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageFont, ImageOps
-from typing import Tuple
+from typing import Iterable, Tuple
+
+
+_FONT = 'VeraBd.ttf'
+_FONT_SIZE = 40
+_SHADOW_RADIUS = 5
+
+# The font size above is for frames of this width, and is scaled for others
+_REFERENCE_WIDTH = 1920
+_CACHE_SIZE = 256
+
+
+class TextTile:
+  """
+  A piece of text rendered onto a small transparent image along with its
+  blurred shadow. 'offset' is the position of the tile's top left corner
+  relative to the point the text is written at
+  """
+  def __init__(self, text: Image, shadow: Image, offset: Tuple[int, int]):
+    self.text = text
+    self.shadow = shadow
+    self.offset = offset
+
+
+class TextRenderer:
+  """
+  Renders text to tiles, loading the font only once. Static text can be
+  rendered up front and is kept for good; anything else is kept in a
+  bounded least-recently-used cache. The shadow is scaled with the font
+  """
+  def __init__(self, font: str = _FONT, size: int = _FONT_SIZE, color=(255,255,255,255),
+               cache_size: int = _CACHE_SIZE):
+    self._font = ImageFont.truetype(font, size)
+    self._shadow_radius = max(round(_SHADOW_RADIUS * size / _FONT_SIZE), 1)
+    self._color = color
+    self._cache_size = cache_size
+    self._static = {}
+    self._cache = OrderedDict()
+
+  def preload(self, texts: Iterable[str]):
+    """
+    Render 'texts' now and keep them for the life of the renderer
+    """
+    for txt in texts:
+      if txt not in self._static:
+        self._static[txt] = self._render(txt)
+
+  def tile(self, txt: str) -> TextTile:
+    """
+    Get the rendered tile for 'txt'
+    """
+    if txt in self._static:
+      return self._static[txt]
+
+    if txt in self._cache:
+      self._cache.move_to_end(txt)
+      return self._cache[txt]
+
+    tile = self._render(txt)
+    self._cache[txt] = tile
+    if len(self._cache) > self._cache_size:
+      self._cache.popitem(last=False)
+    return tile
+
+  def _render(self, txt: str) -> TextTile:
+    left, top, right, bottom = self._font.getbbox(txt)
+    pad = self._shadow_radius * 3
+    text = Image.new('RGBA', (right - left + pad * 2, bottom - top + pad * 2), (0,0,0,0))
+    ImageDraw.Draw(text).text((pad - left, pad - top), txt, font=self._font, fill=self._color)
+    shadow = text.filter(ImageFilter.GaussianBlur(self._shadow_radius))
+    return TextTile(text, shadow, (left - pad, top - pad))
+
+
+_renderers = {}
+
+
+def default_renderer(width: int = _REFERENCE_WIDTH) -> TextRenderer:
+  """
+  Get the TextRenderer shared by everything in this process for frames
+  'width' pixels wide, with the font scaled so text takes up the same
+  share of the frame whatever its size
+  """
+  size = max(round(_FONT_SIZE * width / _REFERENCE_WIDTH), 1)
+  if size not in _renderers:
+    _renderers[size] = TextRenderer(size=size)
+  return _renderers[size]
+
+
+def _alpha_composite(layer: Image, tile: Image, x: int, y: int):
+  """
+  Composite 'tile' onto 'layer' at (x, y), clipping it to the layer
+  """
+  left, top = max(-x, 0), max(-y, 0)
+  right = min(tile.size[0], layer.size[0] - x)
+  bottom = min(tile.size[1], layer.size[1] - y)
+  if left < right and top < bottom:
+    layer.alpha_composite(tile, (x + left, y + top), (left, top, right, bottom))
 
 
 class TextWriter:
-  def __init__(self, base_image):
-    self._base_image = base_image.convert('RGBA')
-    self._text_image = Image.new('RGBA', base_image.size, (0,0,0,0))
-    self._font = ImageFont.truetype('VeraBd.ttf', 40)
-    self._context = ImageDraw.Draw(self._text_image)
-    self._color = (255,255,255,255)
+  """
+  Writes text with drop shadows over an image. Only the bounding box of
+  the text written is composited, and the result is pasted back into the
+  base image in place
+  """
+  def __init__(self, base_image, renderer: TextRenderer = None):
+    self._base_image = base_image
+    self._renderer = renderer or default_renderer(base_image.size[0])
+    self._tiles = []
+    self._box = None
 
   def write(self, x, y, txt):
-    px = int(x * self._text_image.size[0])
-    py = int(y * self._text_image.size[1])
-    self._context.text((px, py), txt, font=self._font, fill=self._color)
+    tile = self._renderer.tile(txt)
+    px = int(x * self._base_image.size[0]) + tile.offset[0]
+    py = int(y * self._base_image.size[1]) + tile.offset[1]
+    self._tiles.append((tile, px, py))
+
+    box = (px, py, px + tile.text.size[0], py + tile.text.size[1])
+    if self._box is None:
+      self._box = box
+    else:
+      self._box = (
+        min(self._box[0], box[0]), min(self._box[1], box[1]),
+        max(self._box[2], box[2]), max(self._box[3], box[3])
+      )
 
   def composite(self):
-    shadow = self._text_image.filter(ImageFilter.GaussianBlur(5))
-    shadowed = Image.alpha_composite(self._base_image, shadow)
-    return Image.alpha_composite(shadowed, self._text_image)
+    if self._box is None:
+      return self._base_image
+
+    width, height = self._base_image.size
+    left, top, right, bottom = self._box
+    box = (max(left, 0), max(top, 0), min(right, width), min(bottom, height))
+    if box[0] >= box[2] or box[1] >= box[3]:
+      return self._base_image
+
+    region = self._base_image.crop(box).convert('RGBA')
+    for tile, x, y in self._tiles:
+      _alpha_composite(region, tile.shadow, x - box[0], y - box[1])
+    for tile, x, y in self._tiles:
+      _alpha_composite(region, tile.text, x - box[0], y - box[1])
+
+    self._base_image.paste(region.convert(self._base_image.mode), box)
+    return self._base_image
 
 
 class DateTimeOverlay:
@@ -28,6 +153,9 @@ class DateTimeOverlay:
     self._x2 = x2
     self._y = y
 
+  def labels(self) -> Iterable[str]:
+    return []
+
   def draw(self, writer: TextWriter, data: dict):
     if 'unix_time' in data:
       dt = datetime.fromtimestamp(data['unix_time'])
@@ -44,6 +172,9 @@ class LabelledDataOverlay:
     self._label = label
     self._fmt = fmt
 
+  def labels(self) -> Iterable[str]:
+    return [self._label]
+
   def draw(self, writer: TextWriter, data: dict):
     if self._key in data:
       writer.write(self._x1, self._y, self._label)
@@ -57,6 +188,9 @@ class PlainDataOverlay:
     self._key = key
     self._fmt = fmt
 
+  def labels(self) -> Iterable[str]:
+    return []
+
   def draw(self, writer: TextWriter, data: dict):
     if self._key in data:
       writer.write(self._x, self._y, self._fmt % data[self._key])
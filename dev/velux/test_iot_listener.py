@@ -0,0 +1,88 @@
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "roles", "velux", "files", "scripts"))
+import fresh_air
+from fresh_air import WindowActuator, WindowController
+from iot_listener import create_shadow_handler
+from metrics import Metrics
+
+
+class FakeShadow:
+    """
+    Stands in for the AWS IoT device shadow, keeping the delta callback and
+    accepting every update
+    """
+    def __init__(self):
+        self.on_delta = None
+        self.updates = []
+
+    def shadowRegisterDeltaCallback(self, callback):
+        self.on_delta = callback
+
+    def shadowUpdate(self, payload, callback, timeout):
+        self.updates.append(json.loads(payload))
+        callback(payload, "accepted", "token")
+
+
+class FakeIoT:
+    def __init__(self):
+        self.shadow = FakeShadow()
+
+    def createShadowHandlerWithName(self, name, persistent):
+        return self.shadow
+
+
+@unittest.skipIf(hasattr(fresh_air, "gpio"), "would operate the real windows")
+class ShadowHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.iot = FakeIoT()
+        self.metrics = Metrics()
+        self.notified = threading.Event()
+        self.states = []
+
+    def deliver(self, delta):
+        def callback(state, on_sent):
+            self.states.append(state)
+            on_sent(time.time())
+            self.notified.set()
+
+        with WindowController() as controller, WindowActuator(controller, min_spacing=0) as actuator:
+            create_shadow_handler(self.iot, actuator, self.metrics, callback)
+            self.iot.shadow.on_delta(json.dumps(delta), None, None)
+            self.assertTrue(self.notified.wait(5))
+        return self.metrics.snapshot()
+
+    def test_records_each_stage_from_the_shadow_change(self):
+        changed = int(time.time()) - 1
+        snapshot = self.deliver({ "state": { "state": "ON" }, "timestamp": changed })
+
+        self.assertEqual(self.states, [True])
+        self.assertEqual(snapshot["counters"], { "deltas": 1, "actuations": 1 })
+        for stage in ("shadow_to_callback", "shadow_to_actuated", "shadow_to_notified",
+                      "callback_to_actuated", "actuated_to_acknowledged", "actuated_to_notified"):
+            self.assertEqual(snapshot["latency"][stage]["count"], 1, stage)
+        self.assertGreaterEqual(snapshot["latency"]["shadow_to_notified"]["max"],
+                                snapshot["latency"]["shadow_to_actuated"]["max"])
+
+        [update] = self.iot.shadow.updates
+        reported = update["state"]["reported"]
+        self.assertEqual(reported["state"], "ON")
+        self.assertIsInstance(reported["completed"], int)
+        self.assertGreaterEqual(reported["completed"], changed)
+
+    def test_skips_shadow_stages_without_a_timestamp(self):
+        snapshot = self.deliver({ "state": { "state": "OFF" } })
+
+        self.assertEqual(self.states, [False])
+        self.assertEqual(sorted(snapshot["latency"].keys()),
+                         ["actuated_to_acknowledged", "actuated_to_notified", "callback_to_actuated"])
+        self.assertEqual(self.iot.shadow.updates[0]["state"]["reported"]["state"], "OFF")
+
+
+if __name__ == "__main__":
+    unittest.main()
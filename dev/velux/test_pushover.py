@@ -0,0 +1,117 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "roles", "velux", "files", "scripts"))
+import pushover
+
+
+class StandIn:
+    """
+    A local stand-in for the Pushover API, answering every message with
+    'status' and keeping the title and text of each one it receives
+    """
+    def __init__(self):
+        self.status = 200
+        self.received = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                query = parse_qs(urlparse(self.path).query)
+                stand_in.received.append((query["title"][0], query["message"][0]))
+                self.send_response(stand_in.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/1/messages.json"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class NotifierTest(unittest.TestCase):
+    def setUp(self):
+        self.api = StandIn()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.api.close()
+        shutil.rmtree(self.spool_dir)
+
+    def spooled(self):
+        return os.listdir(self.spool_dir)
+
+    def test_delivers_coalesced_messages(self):
+        sent = []
+        with pushover.Notifier(self.spool_dir, self.api.url, coalesce=0.2) as notifier:
+            notifier.notify("Fresh Air", "Windows opened!", on_sent=sent.append)
+            notifier.notify("Fresh Air", "Windows closed!", on_sent=sent.append)
+            notifier.notify("Other", "Something else")
+            self.assertTrue(wait_for(lambda: len(self.api.received) == 2))
+
+        self.assertEqual(sorted(self.api.received), [
+            ("Fresh Air", "Windows opened!\nWindows closed!"),
+            ("Other", "Something else")
+        ])
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(self.spooled(), [])
+
+    def test_spools_failed_send_and_retries(self):
+        self.api.status = 503
+        sent = []
+        with pushover.Notifier(self.spool_dir, self.api.url, coalesce=0, retry=0.3) as notifier:
+            notifier.notify("Fresh Air", "Windows opened!", on_sent=sent.append)
+            self.assertTrue(wait_for(lambda: len(self.spooled()) == 1))
+
+            self.api.status = 200
+            self.assertTrue(wait_for(lambda: self.spooled() == []))
+
+        self.assertEqual(self.api.received[-1], ("Fresh Air", "Windows opened!"))
+        self.assertGreaterEqual(len(self.api.received), 2)
+        self.assertEqual(sent, [])
+
+    def test_later_notifier_sends_spool(self):
+        self.api.status = 500
+        with pushover.Notifier(self.spool_dir, self.api.url, coalesce=0) as notifier:
+            notifier.notify("Fresh Air", "Windows closed!")
+        self.assertEqual(len(self.spooled()), 1)
+
+        self.api.status = 200
+        self.api.received.clear()
+        with pushover.Notifier(self.spool_dir, self.api.url, coalesce=0):
+            self.assertTrue(wait_for(lambda: self.spooled() == []))
+        self.assertEqual(self.api.received, [("Fresh Air", "Windows closed!")])
+
+    def test_drops_rejected_message(self):
+        self.api.status = 400
+        with pushover.Notifier(self.spool_dir, self.api.url, coalesce=0) as notifier:
+            notifier.notify("Fresh Air", "Windows opened!")
+        self.assertEqual(len(self.api.received), 1)
+        self.assertEqual(self.spooled(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
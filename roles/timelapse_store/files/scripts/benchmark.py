@@ -0,0 +1,273 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from overlay_pirrigator_data import ImageFile, OverlayData, write_index_file, MIN_BRIGHTNESS
+from PIL import Image, ImageDraw
+from pirrigator_client import PirrigatorClient, NEAREST, PREVIOUS, LINEAR
+
+
+_HISTORY_URL = re.compile(r'/api/(weather|moisture/[^/]+|zone/[^/]+/irrigation)/(\d+)/(\d+)$')
+_CAPTURE_INTERVAL = timedelta(minutes=5)
+_SENSORS = ['Cucumbers', 'Yellow Pigmy', 'Vintage Wine']
+
+
+def fake_response(url: str, interval: int):
+  """
+  Make up a plausible Pirrigator API response for 'url', with a record
+  every 'interval' seconds
+  """
+  if url == '/api/moisture/sensors':
+    return _SENSORS
+  if url == '/api/zone/list':
+    return []
+
+  m = _HISTORY_URL.match(url)
+  if not m:
+    return None
+  kind, start, end = m.group(1), int(m.group(2)), int(m.group(3))
+  times = range(start - start % interval, end + 1, interval)
+
+  if kind == 'weather':
+    return [
+      { 'unix_time': t, 'temperature': 15 + 10 * math.sin(t / 7200), 'humidity': 60 + 20 * math.cos(t / 5400),
+        'pressure': 1010 + 5 * math.sin(t / 86400) }
+      for t in times
+    ]
+  elif kind.startswith('moisture'):
+    return [[t, 400 + int(100 * math.sin(t / 3600))] for t in times]
+  else:
+    return []
+
+
+class FakePirrigator:
+  """
+  A local HTTP stand-in for the Pirrigator API serving made up data, so
+  the real PirrigatorClient is timed including its requests and parsing
+  """
+  def __init__(self, interval: int = 120):
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        body = fake_response(self.path, interval)
+        if body is None:
+          self.send_error(404)
+          return
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.url = f'http://127.0.0.1:{self._server.server_port}/api'
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self._server.shutdown()
+    self._server.server_close()
+
+
+def generate_frames(directory: str, count: int, size, start: datetime, dark: int) -> list:
+  """
+  Write 'count' synthetic JPEG frames named like the camera's, one every
+  capture interval from 'start'. The first 'dark' frames are night frames
+  """
+  paths = []
+  rnd = random.Random(count)
+  for i in range(count):
+    t = start + i * _CAPTURE_INTERVAL
+    if i < dark:
+      image = Image.new('RGB', size, (4, 4, 4))
+    else:
+      level = 60 + (i * 7) % 160
+      image = Image.new('RGB', size, (level, level + 20, level // 2))
+    draw = ImageDraw.Draw(image)
+    for _ in range(0 if i < dark else 40):
+      x, y = rnd.randrange(size[0]), rnd.randrange(size[1])
+      shade = min(level + rnd.randrange(60), 255)
+      draw.ellipse((x, y, x + rnd.randrange(20, 200), y + rnd.randrange(20, 200)), fill=(shade // 2, shade, shade // 3))
+    path = os.path.join(directory, f'img{t:%m%d%H%M%S}.jpg')
+    image.save(path, quality=90)
+    paths.append(path)
+  return paths
+
+
+class StageTimer:
+  """
+  Collects wall clock timings for named stages
+  """
+  def __init__(self):
+    self.samples = {}
+
+  @contextmanager
+  def stage(self, name: str):
+    start = time.perf_counter()
+    yield
+    self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+  def summary(self) -> dict:
+    def percentile(s, p):
+      return s[min(int(len(s) * p / 100), len(s) - 1)]
+
+    summary = {}
+    for name, samples in self.samples.items():
+      s = sorted(samples)
+      summary[name] = {
+        'count': len(s),
+        'total_s': sum(s),
+        'mean_ms': 1000 * sum(s) / len(s),
+        'p50_ms': 1000 * percentile(s, 50),
+        'p95_ms': 1000 * percentile(s, 95),
+        'max_ms': 1000 * s[-1]
+      }
+    return summary
+
+
+def run(paths: list, sampling: str, api_url: str) -> dict:
+  """
+  Run each stage of the overlay pipeline over 'paths', timing each one
+  through the same entry points the scripts use
+  """
+  timer = StageTimer()
+  started = time.perf_counter()
+
+  with timer.stage('load'):
+    images = sorted((ImageFile(p) for p in paths), key=ImageFile.datetime)
+
+  bright = []
+  for image in images:
+    with timer.stage('brightness'):
+      if image.brightness() > MIN_BRIGHTNESS:
+        bright.append(image)
+
+  times = [i.datetime() for i in bright]
+  start, end = times[0], times[-1] + timedelta(minutes=10)
+  client = PirrigatorClient(api_url)
+  with timer.stage('fetch'):
+    history = client.history(start, end, zones=[])
+
+  with timer.stage('sample'):
+    history.weather.sample(times, sampling)
+    for series in history.moisture.values():
+      series.sample(times, sampling)
+
+  with timer.stage('overlay_data'):
+    data = OverlayData(client, start, end, times, sampling)
+
+  outputs = []
+  for image in bright:
+    with timer.stage('decode'):
+      image.image()
+
+    with timer.stage('overlay'):
+      data.draw(image)
+
+    with timer.stage('save'):
+      outputs.append(image.save())
+
+  with timer.stage('index'):
+    write_index_file(os.path.join(os.path.dirname(paths[0]), 'index.txt'), outputs)
+
+  elapsed = time.perf_counter() - started
+  return {
+    'frames': len(images),
+    'rendered': len(outputs),
+    'elapsed_s': elapsed,
+    'frames_per_s': len(images) / elapsed,
+    'ms_per_frame': 1000 * elapsed / len(images),
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'stages': timer.summary()
+  }
+
+
+def parse_command_line_args():
+  """
+  Parse the command line arguments. Returns the args object
+  """
+  parser = argparse.ArgumentParser(description='Benchmark the timelapse overlay pipeline on synthetic frames')
+
+  parser.add_argument(
+    '--frames',
+    action='store',
+    type=int,
+    default=48,
+    help='Number of frames to generate'
+  )
+
+  parser.add_argument(
+    '--dark',
+    action='store',
+    type=int,
+    default=4,
+    help='Number of the frames which are too dark to include'
+  )
+
+  parser.add_argument(
+    '--size',
+    action='store',
+    default='1920x1080',
+    help='Frame size as WIDTHxHEIGHT'
+  )
+
+  parser.add_argument(
+    '--sampling',
+    action='store',
+    choices=[NEAREST, PREVIOUS, LINEAR],
+    default=LINEAR,
+    help='How to sample the Pirrigator data at each image time'
+  )
+
+  parser.add_argument(
+    '--dir',
+    action='store',
+    help='Directory to generate the frames in, by default a temporary directory'
+  )
+
+  parser.add_argument(
+    '--output',
+    action='store',
+    help='Write the JSON report here instead of to stdout'
+  )
+
+  return parser.parse_args()
+
+
+if __name__ == "__main__":
+  args = parse_command_line_args()
+  logging.basicConfig(level=logging.WARNING)
+  size = tuple(int(x) for x in args.size.split('x'))
+  start = datetime(datetime.today().year, 6, 21, 4, 0, 0)
+
+  with tempfile.TemporaryDirectory() as tmp:
+    directory = args.dir or tmp
+    os.makedirs(directory, exist_ok=True)
+    paths = generate_frames(directory, args.frames, size, start, args.dark)
+    with FakePirrigator() as api:
+      report = run(paths, args.sampling, api.url)
+    report['config'] = { 'frames': args.frames, 'dark': args.dark, 'size': args.size, 'sampling': args.sampling }
+
+  if args.output:
+    with open(args.output, 'wt') as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
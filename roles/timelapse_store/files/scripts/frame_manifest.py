@@ -0,0 +1,284 @@
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+from datetime import date, datetime
+from PIL import Image
+from typing import List, Tuple
+
+
+# The states a frame passes through, in order
+CAPTURED = 'captured'
+CHECKED = 'checked'
+OVERLAID = 'overlaid'
+ENCODED = 'encoded'
+
+_NAME_FORMAT = re.compile(r'img(\d\d)(\d\d)(\d\d)(\d\d)(\d\d).jpg$')
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+_ENTRY_FIELDS = ('sha1', 'state', 'brightness', 'fingerprint', 'taken', 'slots')
+
+_SCHEMA_VERSION = 3
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+  taken TEXT PRIMARY KEY,
+  name TEXT NOT NULL UNIQUE,
+  size INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  sha1 TEXT NOT NULL,
+  state TEXT NOT NULL,
+  brightness REAL,
+  fingerprint TEXT,
+  slots INTEGER NOT NULL DEFAULT 1,
+  width INTEGER,
+  height INTEGER
+);
+'''
+
+
+def capture_time(name: str, reference: datetime) -> datetime:
+  """
+  Get the capture time of the frame called 'name'. The file name has no
+  year, so this takes the year which puts the capture time closest to
+  'reference', normally the file's modification time. That way a frame
+  from late December is still placed in the right year when it is
+  processed in January
+  """
+  m = _NAME_FORMAT.match(name)
+  assert m, f"{name} is not in the expected filename format"
+  month, day, hour, minute, second = (int(s) for s in m.groups())
+
+  candidates = []
+  for year in (reference.year - 1, reference.year, reference.year + 1):
+    try:
+      candidates.append(datetime(year, month, day, hour, minute, second))
+    except ValueError:
+      pass  # 29th February
+  return min(candidates, key=lambda t: abs(t - reference))
+
+
+def _sha1(path: str) -> str:
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 16), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class FrameManifest:
+  """
+  A catalogue of the frames in a directory, keyed and indexed by full
+  capture time, recording how far each one has got through the pipeline
+  along with its brightness, dimensions and a hash of its contents so
+  that a frame which changes goes back to the start. The manifest lives
+  in the directory with the frames, picks up new frames when opened and
+  forgets any frame whose file has gone
+  """
+  def __init__(self, path: str):
+    self._directory = os.path.dirname(os.path.abspath(path))
+    self._db = sqlite3.connect(path, timeout=30)
+    if self._db.execute('PRAGMA user_version').fetchone()[0] != _SCHEMA_VERSION:
+      with self._db:
+        self._db.execute('DROP TABLE IF EXISTS frames')
+        self._db.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+    self._db.executescript(_SCHEMA)
+    self.scan()
+
+  def close(self):
+    self._db.close()
+
+  def scan(self):
+    """
+    Add any frames in the directory not yet in the manifest, and drop those
+    no longer there
+    """
+    present = set(n for n in os.listdir(self._directory) if _NAME_FORMAT.match(n))
+    known = set(n for n, in self._db.execute('SELECT name FROM frames'))
+
+    with self._db:
+      self._db.executemany('DELETE FROM frames WHERE name = ?', ((n,) for n in known - present))
+    for name in sorted(present - known):
+      try:
+        self._entry(os.path.join(self._directory, name))
+      except OSError:
+        logging.exception(f'Failed to add {name}')
+
+  def _entry(self, path: str) -> dict:
+    """
+    Get the entry for the frame at 'path', creating it or resetting it to
+    CAPTURED if the file contents have changed. The file is only hashed
+    if its size or modification time differ from what was recorded
+    """
+    name = os.path.basename(path)
+    st = os.stat(path)
+    row = self._db.execute(
+      'SELECT size, mtime, sha1, state, brightness, fingerprint, taken, slots FROM frames WHERE name = ?', (name,)
+    ).fetchone()
+
+    if row is not None and row[:2] == (st.st_size, st.st_mtime):
+      return dict(zip(_ENTRY_FIELDS, row[2:]))
+
+    sha1 = _sha1(path)
+    if row is not None and row[2] == sha1:
+      entry = dict(zip(_ENTRY_FIELDS, row[2:]))
+    else:
+      if row is not None:
+        logging.info(f'{name} has changed')
+      taken = capture_time(name, datetime.fromtimestamp(st.st_mtime))
+      entry = {
+        'sha1': sha1, 'state': CAPTURED, 'brightness': None, 'fingerprint': None,
+        'taken': taken.strftime(_TIME_FORMAT), 'slots': 1
+      }
+
+    # Only the header is read for the dimensions
+    with Image.open(path) as image:
+      width, height = image.size
+
+    with self._db:
+      self._db.execute(
+        'INSERT OR REPLACE INTO frames '
+        '(taken, name, size, mtime, sha1, state, brightness, fingerprint, slots, width, height) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (entry['taken'], name, st.st_size, st.st_mtime, sha1, entry['state'], entry['brightness'],
+         entry['fingerprint'], entry['slots'], width, height)
+      )
+    return entry
+
+  def state(self, path: str) -> str:
+    """
+    Get the state of the frame at 'path'
+    """
+    return self._entry(path)['state']
+
+  def taken(self, path: str) -> datetime:
+    """
+    Get the capture time of the frame at 'path'
+    """
+    return datetime.strptime(self._entry(path)['taken'], _TIME_FORMAT)
+
+  def mark(self, path: str, state: str):
+    """
+    Record that the frame at 'path' has reached 'state'
+    """
+    self._entry(path)
+    with self._db:
+      self._db.execute('UPDATE frames SET state = ? WHERE name = ?', (state, os.path.basename(path)))
+
+  def _measured(self, image) -> dict:
+    """
+    Get the entry for 'image', measuring its brightness and fingerprint
+    only if not already known
+    """
+    entry = self._entry(image.path())
+    if entry['brightness'] is None or entry['fingerprint'] is None:
+      entry['brightness'] = image.brightness()
+      entry['fingerprint'] = image.fingerprint()
+      if entry['state'] == CAPTURED:
+        entry['state'] = CHECKED
+      with self._db:
+        self._db.execute(
+          'UPDATE frames SET state = ?, brightness = ?, fingerprint = ? WHERE name = ?',
+          (entry['state'], entry['brightness'], entry['fingerprint'], os.path.basename(image.path()))
+        )
+    return entry
+
+  def brightness(self, image) -> float:
+    """
+    Get the brightness of 'image', measuring it only if not already known
+    """
+    return self._measured(image)['brightness']
+
+  def fingerprint(self, image) -> str:
+    """
+    Get the fingerprint of 'image', measuring it only if not already known
+    """
+    return self._measured(image)['fingerprint']
+
+  def slots(self, path: str) -> int:
+    """
+    Get the number of frame times the frame at 'path' is shown for, which
+    is more than one if later similar frames were merged into it, or zero
+    if it was itself merged into an earlier frame
+    """
+    return self._entry(path)['slots']
+
+  def set_slots(self, path: str, slots: int):
+    """
+    Record the number of frame times the frame at 'path' is shown for
+    """
+    self._entry(path)
+    with self._db:
+      self._db.execute('UPDATE frames SET slots = ? WHERE name = ?', (slots, os.path.basename(path)))
+
+  def save(self):
+    """
+    Nothing to do; every change is committed as it is made
+    """
+    pass
+
+  def rendered(self, image) -> bool:
+    """
+    Whether 'image' has been overlaid since it last changed and its
+    composite image is still on disk
+    """
+    return self.state(image.path()) in (OVERLAID, ENCODED) and os.path.isfile(image.out_path())
+
+  def frames(self, start: datetime, end: datetime) -> List[Tuple[str, datetime]]:
+    """
+    Get the paths and capture times of the frames taken from 'start' up to
+    but not including 'end', in date order
+    """
+    rows = self._db.execute(
+      'SELECT name, taken FROM frames WHERE taken >= ? AND taken < ? ORDER BY taken',
+      (start.strftime(_TIME_FORMAT), end.strftime(_TIME_FORMAT))
+    )
+    return [(os.path.join(self._directory, name), datetime.strptime(taken, _TIME_FORMAT)) for name, taken in rows]
+
+  def days(self, before: date) -> List[date]:
+    """
+    Get the days before 'before' which have frames
+    """
+    rows = self._db.execute(
+      'SELECT DISTINCT substr(taken, 1, 10) FROM frames WHERE taken < ? ORDER BY 1',
+      (before.strftime(_TIME_FORMAT),)
+    )
+    return [date.fromisoformat(day) for day, in rows]
+
+
+def parse_command_line_args():
+  """
+  Parse the command line arguments. Returns the args object
+  """
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    'manifest',
+    metavar='PATH',
+    type=str,
+    help='Manifest file, in the same directory as the images'
+  )
+
+  parser.add_argument(
+    '--days',
+    action='store_true',
+    help='List the days with images, as YYYY-MM-DD'
+  )
+
+  parser.add_argument(
+    '--before',
+    action='store',
+    type=date.fromisoformat,
+    default=date.today(),
+    help='Only list days before this one, as YYYY-MM-DD; by default today'
+  )
+
+  return parser.parse_args()
+
+
+if __name__ == "__main__":
+  args = parse_command_line_args()
+  manifest = FrameManifest(args.manifest)
+  if args.days:
+    for day in manifest.days(args.before):
+      print(day.isoformat())
@@ -0,0 +1,216 @@
+import argparse
+import glob
+import logging
+import os
+import requests
+import time
+from datetime import datetime, timedelta
+from frame_manifest import FrameManifest, OVERLAID
+from overlay_pirrigator_data import ImageFile, OverlayData, SimilarFrames, merge_similar, \
+  FRAME_DURATION, MIN_BRIGHTNESS
+from history_cache import HistoryCache
+from pirrigator_client import PirrigatorClient, NEAREST, PREVIOUS, LINEAR
+from segments import SegmentStore
+from typing import List
+
+
+# How far either side of the images to fetch Pirrigator data for
+_DATA_WINDOW = timedelta(minutes=10)
+
+
+class OverlayWatcher:
+  """
+  Watches a directory for new timelapse images and overlays the Pirrigator
+  data on each one shortly after it arrives, so the nightly job only has
+  to encode the composite images
+  """
+  def __init__(self, directory: str, client: PirrigatorClient, sampling: str, settle: float,
+               segments: SegmentStore = None, manifest: FrameManifest = None, merge_similar: int = None):
+    self._directory = directory
+    self._client = client
+    self._sampling = sampling
+    self._settle = settle
+    self._segments = segments
+    self._manifest = manifest
+    self._similar = SimilarFrames(merge_similar, manifest) if merge_similar is not None else None
+    self._done = set()
+
+  def pending(self) -> List[ImageFile]:
+    """
+    Find the images which have not been processed yet and have not been
+    modified for at least the settle time, in date order
+    """
+    paths = glob.glob(os.path.join(self._directory, 'img*.jpg'))
+    self._done.intersection_update(paths)
+
+    now = time.time()
+    images = []
+    for path in paths:
+      if path in self._done:
+        continue
+      try:
+        if now - os.path.getmtime(path) < self._settle:
+          continue
+        image = ImageFile(path)
+      except (OSError, AssertionError):
+        continue
+      if self._rendered(image):
+        self._done.add(path)
+      else:
+        images.append(image)
+
+    return sorted(images, key=ImageFile.datetime)
+
+  def process(self, images: List[ImageFile]):
+    """
+    Overlay and save 'images', fetching the Pirrigator data for all of
+    them at once. Similar frames are only merged once the data is there,
+    so a failed fetch leaves nothing half recorded for the retry
+    """
+    images = [i for i in images if self._bright_enough(i)]
+    if not images:
+      return
+
+    times = [i.datetime() for i in images]
+    data = OverlayData(self._client, times[0] - _DATA_WINDOW, times[-1] + _DATA_WINDOW, times, self._sampling)
+    if self._similar:
+      images, _ = merge_similar(images, self._similar, self._manifest)
+    for image in images:
+      try:
+        data.draw(image).save()
+        if self._manifest:
+          self._manifest.mark(image.path(), OVERLAID)
+      except OSError:
+        logging.exception(f'Failed to process {image.path()}')
+      finally:
+        image.release()
+      self._done.add(image.path())
+
+  def _rendered(self, image: ImageFile) -> bool:
+    """
+    Whether 'image' has been overlaid already, or merged into an earlier
+    similar image so doesn't need to be
+    """
+    if self._manifest:
+      return self._manifest.rendered(image) or self._manifest.slots(image.path()) == 0
+    return image.rendered()
+
+  def _bright_enough(self, image: ImageFile) -> bool:
+    try:
+      brightness = self._manifest.brightness(image) if self._manifest else image.brightness()
+      if brightness > MIN_BRIGHTNESS:
+        return True
+      logging.info(f'Skipping dark image {image.path()}')
+    except OSError:
+      logging.exception(f'Failed to read {image.path()}')
+    self._done.add(image.path())
+    return False
+
+  def run(self, interval: float):
+    """
+    Scan for new images every 'interval' seconds, forever. Images which
+    fail because Pirrigator can't be reached are retried on the next scan.
+    If there is a segment store, each hour is encoded once it has closed
+    """
+    while True:
+      try:
+        self.process(self.pending())
+      except requests.RequestException:
+        logging.exception('Failed to fetch Pirrigator data')
+
+      if self._segments:
+        try:
+          self._segments.encode_closed(datetime.now())
+        except (OSError, RuntimeError):
+          logging.exception('Failed to encode segments')
+
+      time.sleep(interval)
+
+
+def parse_command_line_args():
+  """
+  Parse the command line arguments. Returns the args object
+  """
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    'directory',
+    metavar='DIR',
+    type=str,
+    help='Directory to watch for new images'
+  )
+
+  parser.add_argument(
+    '--pirrigator',
+    action='store',
+    default='http://pirrigator:5000/api',
+    help='Base URL for Pirrigator API'
+  )
+
+  parser.add_argument(
+    '--cache',
+    action='store',
+    help='Path to a local database to cache Pirrigator history in'
+  )
+
+  parser.add_argument(
+    '--sampling',
+    action='store',
+    choices=[NEAREST, PREVIOUS, LINEAR],
+    default=NEAREST,
+    help='How to sample the Pirrigator data at each image time'
+  )
+
+  parser.add_argument(
+    '--interval',
+    action='store',
+    type=float,
+    default=30,
+    help='Seconds between scans of the directory'
+  )
+
+  parser.add_argument(
+    '--settle',
+    action='store',
+    type=float,
+    default=60,
+    help='Seconds an image must be left unmodified before it is processed'
+  )
+
+  parser.add_argument(
+    '--segments',
+    action='store',
+    help='Encode each hour of composite images into a video segment in this directory'
+  )
+
+  parser.add_argument(
+    '--manifest',
+    action='store',
+    help='Path to a manifest recording how far each image has been processed'
+  )
+
+  parser.add_argument(
+    '--merge-similar',
+    action='store',
+    type=int,
+    metavar='BITS',
+    help='Merge runs of consecutive images whose fingerprints differ in no more than '
+         'this many bits into one image shown for longer. Needs --manifest'
+  )
+
+  args = parser.parse_args()
+  if args.merge_similar is not None and not args.manifest:
+    parser.error('--merge-similar needs --manifest')
+  return args
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  args = parse_command_line_args()
+  history_cache = HistoryCache(args.cache) if args.cache else None
+  client = PirrigatorClient(args.pirrigator, cache=history_cache)
+  manifest = FrameManifest(args.manifest) if args.manifest else None
+  segments = SegmentStore(args.directory, args.segments, 1 / FRAME_DURATION, manifest=manifest) \
+    if args.segments else None
+  OverlayWatcher(args.directory, client, args.sampling, args.settle, segments, manifest, args.merge_similar) \
+    .run(args.interval)
@@ -1,7 +1,30 @@
+import codecs
+import json
 import logging
+import math
 import requests
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, time, timedelta, timezone
+from history_cache import HistoryCache
 from munch import munchify, Munch
+from requests.adapters import HTTPAdapter
+from time import perf_counter
+from typing import Callable, Iterable, Iterator, List, Tuple
+from urllib3.util.retry import Retry
+
+
+# (connect, read) timeouts in seconds for each API call
+_TIMEOUT = (5, 30)
+_RETRIES = 5
+_RETRY_BACKOFF = 0.5
+_MAX_CONNECTIONS = 8
+
+# Long history requests are split into windows of this length, fetched
+# concurrently, and each response is parsed in chunks of this size
+_WINDOW = timedelta(hours=6)
+_CHUNK_SIZE = 64 * 1024
 
 
 def _int_ts(dt: datetime) -> int:
@@ -11,41 +34,328 @@ def _int_ts(dt: datetime) -> int:
   return int(dt.timestamp())
 
 
+# Sampling modes for 'TimeSeries.sample()'
+NEAREST = 'nearest'
+PREVIOUS = 'previous'
+LINEAR = 'linear'
+
+
+def _typecode(value) -> str:
+  return { int: 'q', float: 'd' }.get(type(value))
+
+
+def _missing(value) -> bool:
+  return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _new_column(value, n: int):
+  """
+  Start a column whose first value, 'value', is in row 'n'
+  """
+  typecode = _typecode(value)
+  if n == 0 and typecode:
+    return array(typecode, [value])
+  if typecode or value is None:
+    return array('d', [math.nan] * n + [math.nan if value is None else value])
+  return [None] * n + [value]
+
+
+def _append(column, value):
+  """
+  Append 'value' to 'column', returning the column. Columns of one numeric
+  type are stored compactly as arrays, with missing values as NaN;
+  integers are widened to floats if needed, and anything else turns the
+  column into a list
+  """
+  if isinstance(column, array):
+    typecode = 'd' if value is None else _typecode(value)
+    if typecode == column.typecode or (typecode == 'q' and column.typecode == 'd'):
+      column.append(math.nan if value is None else value)
+      return column
+    column = array('d', column) if typecode == 'd' else list(column)
+    if value is None and typecode == 'd':
+      value = math.nan
+  column.append(value)
+  return column
+
+
+def _take(column, indexes: List[int]):
+  if isinstance(column, array):
+    return array(column.typecode, (column[i] for i in indexes))
+  return [column[i] for i in indexes]
+
+
+def _json_array_items(chunks: Iterable[bytes]) -> Iterator:
+  """
+  Parse a JSON array arriving in 'chunks' of UTF-8, yielding each item as
+  soon as it is complete, so only one chunk and one item are held at once
+  """
+  decoder = json.JSONDecoder()
+  utf8 = codecs.getincrementaldecoder('utf-8')()
+  chunks = iter(chunks)
+  buf, pos, more, opened = '', 0, True, False
+
+  while True:
+    while pos < len(buf) and buf[pos] in ' \t\r\n,':
+      pos += 1
+
+    if pos < len(buf):
+      if not opened:
+        if buf[pos] != '[':
+          raise ValueError('expected a JSON array')
+        opened = True
+        pos += 1
+        continue
+      if buf[pos] == ']':
+        return
+      try:
+        item, end = decoder.raw_decode(buf, pos)
+        # Until the separator after an item arrives, it may be a number
+        # which has been cut short
+        after = end
+        while after < len(buf) and buf[after] in ' \t\r\n':
+          after += 1
+        if (after < len(buf) and buf[after] in ',]') or not more:
+          yield item
+          pos = end
+          continue
+      except json.JSONDecodeError:
+        if not more:
+          raise
+    elif not more:
+      raise ValueError('unexpected end of JSON array')
+
+    buf, pos = buf[pos:], 0
+    chunk = next(chunks, None)
+    if chunk is None:
+      more = False
+      buf += utf8.decode(b'', final=True)
+    else:
+      buf += utf8.decode(chunk)
+
+
 class TimeSeries:
   """
-  A time series group of records
+  A time series group of records, held in time order as one array of
+  timestamps plus an array per field. The records are consumed one at a
+  time, so can be streamed straight in from a response, and need not be
+  in order; if more than one has the same time, the first is kept
   """
-  def __init__(self, records):
-    self._records = munchify(list(dict(d) for d in records))
+  def __init__(self, records: Iterable[dict] = ()):
+    times = array('q')
+    columns = {}
+    tidy = True
+    for n, r in enumerate(records):
+      t = r['unix_time']
+      if n > 0 and t <= times[-1]:
+        tidy = False
+      times.append(t)
+      for k, v in r.items():
+        if k != 'unix_time':
+          columns[k] = _new_column(v, n) if k not in columns else _append(columns[k], v)
+      for k, column in columns.items():
+        if len(column) == n:
+          columns[k] = _append(column, None)
+
+    if not tidy:
+      order = sorted(range(len(times)), key=times.__getitem__)
+      order = [i for j, i in enumerate(order) if j == 0 or times[i] != times[order[j-1]]]
+      times = _take(times, order)
+      columns = { k: _take(column, order) for k, column in columns.items() }
+
+    self._times = times
+    self._columns = columns
+
+    # The rows with a value, for each numeric column with any missing
+    self._present = {
+      k: array('q', (i for i, v in enumerate(column) if not math.isnan(v)))
+      for k, column in columns.items()
+      if isinstance(column, array) and column.typecode == 'd' and any(math.isnan(v) for v in column)
+    }
+
+  def __len__(self):
+    return len(self._times)
+
+  def _record(self, i: int) -> Munch:
+    """
+    Build the record at index 'i'
+    """
+    record = Munch(unix_time=self._times[i])
+    for k, column in self._columns.items():
+      if not _missing(column[i]):
+        record[k] = column[i]
+    return record
+
+  def _sweep(self, timestamps: List[int]):
+    """
+    Yields (k, i) for each of 'timestamps' in time order, where 'k' is the
+    position in 'timestamps' and 'i' is the insertion point in the series.
+    The insertion points are found in a single sweep through the series
+    """
+    lo = 0
+    for k in sorted(range(len(timestamps)), key=timestamps.__getitem__):
+      lo = bisect_left(self._times, timestamps[k], lo)
+      yield k, lo
+
+  def _nearest_to(self, timestamp: int, i: int) -> int:
+    """
+    Choose between the records either side of insertion point 'i'
+    """
+    if i == len(self._times) or (i > 0 and timestamp - self._times[i-1] <= self._times[i] - timestamp):
+      return i - 1
+    return i
 
   def at(self, dt: datetime) -> Munch:
     """
     Get the record closest in time to 'dt'
     """
-    if len(self._records) > 0:
+    if len(self._times) > 0:
       timestamp = _int_ts(dt)
-      return min(self._records, key=lambda r: abs(timestamp - r['unix_time']))
+      return self._record(self._nearest_to(timestamp, bisect_left(self._times, timestamp)))
     else:
       return {}
 
+  def at_many(self, dts: Iterable[datetime]) -> List[Munch]:
+    """
+    Get the records closest in time to each of 'dts', in the same order.
+    The times are resolved in a single sweep through the series
+    """
+    return self.sample(dts, NEAREST)
+
+  def sample(self, dts: Iterable[datetime], mode: str = NEAREST) -> List[Munch]:
+    """
+    Sample the series at each of 'dts', returning records in the same order.
+    'mode' is one of:
+      NEAREST  - the record closest in time
+      PREVIOUS - the latest record at or before the time
+      LINEAR   - numeric fields interpolated between the records either side
+    Times outside the series take the first or last record
+    """
+    if mode not in (NEAREST, PREVIOUS, LINEAR):
+      raise ValueError(f'unknown sampling mode {mode}')
+
+    timestamps = [_int_ts(dt) for dt in dts]
+    if len(self._times) == 0:
+      return [{} for _ in timestamps]
+
+    records = [None] * len(timestamps)
+    last = len(self._times) - 1
+    for k, i in self._sweep(timestamps):
+      timestamp = timestamps[k]
+      exact = i <= last and self._times[i] == timestamp
+      if mode == NEAREST:
+        records[k] = self._record(self._nearest_to(timestamp, i))
+      elif exact or i == 0 or i > last:
+        records[k] = self._record(min(i, last))
+      elif mode == PREVIOUS:
+        records[k] = self._record(i - 1)
+      else:
+        records[k] = self._interpolate(timestamp, i - 1, i)
+    return records
+
+  def _around(self, k: str, i: int, j: int) -> Tuple[int, int]:
+    """
+    Find the nearest rows at or before 'i' and at or after 'j' which have a
+    value for numeric field 'k', giving None for either if there is none
+    """
+    present = self._present.get(k)
+    if present is None:
+      return i, j
+    n = bisect_left(present, j)
+    return (present[n-1] if n > 0 else None), (present[n] if n < len(present) else None)
+
+  def _interpolate(self, timestamp: int, i: int, j: int) -> Munch:
+    """
+    Build a record at 'timestamp' between records 'i' and 'j', interpolating
+    the numeric fields between the nearest records either side with a value
+    and taking anything else from the nearer record. A numeric field with a
+    value on one side only takes that value
+    """
+    record = self._record(self._nearest_to(timestamp, j))
+    record.unix_time = timestamp
+    for k, column in self._columns.items():
+      if isinstance(column, array):
+        before, after = self._around(k, i, j)
+        if before is not None and after is not None:
+          f = (timestamp - self._times[before]) / (self._times[after] - self._times[before])
+          record[k] = column[before] + (column[after] - column[before]) * f
+        elif before is not None or after is not None:
+          record[k] = column[after if before is None else before]
+    return record
+
+  def records(self) -> Iterator[Munch]:
+    """
+    Yields each record in time order
+    """
+    for i in range(len(self._times)):
+      yield self._record(i)
+
   def __str__(self):
-    return str(sorted(self._records, key=lambda r: r['unix_time']))
+    return str(list(self.records()))
 
 
 class PirrigatorClient:
   """
-  A client for the Pirrigator API
+  A client for the Pirrigator API. Connections are kept alive and shared
+  between calls, and failed calls are retried with exponential backoff.
+  If given a 'HistoryCache', history already fetched is not fetched again.
+  'on_request' is called with the URL, duration and size of each API call
   """
-  def __init__(self, base_url: str):
+  def __init__(self, base_url: str, timeout=_TIMEOUT, retries: int = _RETRIES,
+               max_connections: int = _MAX_CONNECTIONS, cache: HistoryCache = None,
+               on_request: Callable[[str, float, int], None] = None):
     self._base = base_url
+    self._cache = cache
+    self._on_request = on_request
+    self._timeout = timeout
+    self._max_connections = max_connections
+
+    # Only ever runs single window fetches, so it can't deadlock with the
+    # pool in history() waiting on it
+    self._windows = ThreadPoolExecutor(max_connections)
+
+    retry = Retry(
+      total=retries,
+      backoff_factor=_RETRY_BACKOFF,
+      status_forcelist=(500, 502, 503, 504)
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, max_retries=retry)
+    self._session = requests.Session()
+    self._session.mount('http://', adapter)
+    self._session.mount('https://', adapter)
 
   def _apicall(self, url: str):
     logging.debug(f'GET {url}')
-    rsp = requests.get(f'{self._base}{url}')
+    started = perf_counter()
+    rsp = self._session.get(f'{self._base}{url}', timeout=self._timeout)
+    rsp.raise_for_status()
     json = rsp.json()
+    if self._on_request:
+      self._on_request(url, perf_counter() - started, len(rsp.content))
     logging.debug(f'{rsp.status_code} {json}')
     return json
 
+  def _apistream(self, url: str) -> Iterator:
+    """
+    Make an API call returning a JSON array, yielding the items as the
+    response is parsed rather than reading it all first
+    """
+    logging.debug(f'GET {url}')
+    started = perf_counter()
+    size = 0
+
+    def counted(chunks):
+      nonlocal size
+      for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+
+    with self._session.get(f'{self._base}{url}', timeout=self._timeout, stream=True) as rsp:
+      rsp.raise_for_status()
+      yield from _json_array_items(counted(rsp.iter_content(_CHUNK_SIZE)))
+    if self._on_request:
+      self._on_request(url, perf_counter() - started, size)
+
   def zones(self):
     """
     Get the list of configured zone names
@@ -59,28 +369,92 @@ class PirrigatorClient:
     """
     return munchify(self._apicall('/moisture/sensors'))
 
+  def _fetch(self, url: Callable[[int, int], str], convert: Callable[[object], dict],
+             start: int, end: int) -> TimeSeries:
+    """
+    Fetch the records between timestamps 'start' and 'end' as a 'TimeSeries',
+    splitting the range into windows which are fetched concurrently. Each
+    response is parsed as it arrives, with 'convert' turning each item into
+    a record, straight into a compact 'TimeSeries'; these are then joined
+    """
+    step = int(_WINDOW.total_seconds())
+    windows = [(s, min(s + step, end)) for s in range(start, end, step)] or [(start, end)]
+    parts = self._windows.map(lambda w: TimeSeries(convert(r) for r in self._apistream(url(*w))), windows)
+    if len(windows) == 1:
+      return next(parts)
+    return TimeSeries(r for part in parts for r in part.records())
+
+  def _history(self, series: str, start: datetime, end: datetime,
+               url: Callable[[int, int], str], convert: Callable[[object], dict]) -> TimeSeries:
+    """
+    Get the records of 'series' between 'start' and 'end' as a 'TimeSeries',
+    going through the cache if there is one. See '_fetch()'
+    """
+    if self._cache:
+      return TimeSeries(self._cache.get(series, _int_ts(start), _int_ts(end), lambda s, e:
+        self._fetch(url, convert, s, e).records()
+      ))
+    return self._fetch(url, convert, _int_ts(start), _int_ts(end))
+
   def weather_history(self, start: datetime, end: datetime) -> TimeSeries:
     """
     Get all weather records between 'start' and 'end' as a 'TimeSeries'
     """
-    return TimeSeries(self._apicall(f'/weather/{_int_ts(start)}/{_int_ts(end)}'))
+    return self._history('weather', start, end,
+      lambda s, e: f'/weather/{s}/{e}',
+      lambda r: r
+    )
 
   def moisture_history(self, sensor: str, start: datetime, end: datetime) -> TimeSeries:
     """
     Get all moisture records between 'start' and 'end' as a 'TimeSeries'
     """
-    data = self._apicall(f'/moisture/{sensor}/{_int_ts(start)}/{_int_ts(end)}')
-    return TimeSeries({ 'unix_time': r[0], 'value': r[1] } for r in data)
+    return self._history(f'moisture/{sensor}', start, end,
+      lambda s, e: f'/moisture/{sensor}/{s}/{e}',
+      lambda r: { 'unix_time': r[0], 'value': r[1] }
+    )
 
   def irrigation_history(self, zone: str, start: datetime, end: datetime) -> TimeSeries:
     """
     Get all the irrigation records between 'start' and 'end' as a 'TimeSeries'
     """
-    data = self._apicall(f'/zone/{zone}/irrigation/{_int_ts(start)}/{_int_ts(end)}')
-    return TimeSeries({ 'unix_time': r[0], 'duration': r[1]['secs'] } for r in data)
+    return self._history(f'irrigation/{zone}', start, end,
+      lambda s, e: f'/zone/{zone}/irrigation/{s}/{e}',
+      lambda r: { 'unix_time': r[0], 'duration': r[1]['secs'] }
+    )
+
+  def history(self, start: datetime, end: datetime, sensors: List[str] = None,
+              zones: List[str] = None) -> Munch:
+    """
+    Get the weather history, the moisture history for each of 'sensors' and
+    the irrigation history for each of 'zones' between 'start' and 'end',
+    fetching them all concurrently. 'sensors' and 'zones' default to all
+    of them. The result has 'weather', 'moisture' and 'irrigation' fields,
+    the last two being dicts of 'TimeSeries' by name
+    """
+    with ThreadPoolExecutor(self._max_connections) as pool:
+      weather = pool.submit(self.weather_history, start, end)
+      all_sensors = pool.submit(self.moisture_sensors) if sensors is None else None
+      all_zones = pool.submit(self.zones) if zones is None else None
+
+      moisture = {
+        sensor: pool.submit(self.moisture_history, sensor, start, end)
+        for sensor in (sensors if all_sensors is None else all_sensors.result())
+      }
+      irrigation = {
+        zone: pool.submit(self.irrigation_history, zone, start, end)
+        for zone in (zones if all_zones is None else all_zones.result())
+      }
+
+      return Munch(
+        weather=weather.result(),
+        moisture={ sensor: f.result() for sensor, f in moisture.items() },
+        irrigation={ zone: f.result() for zone, f in irrigation.items() }
+      )
 
 
 if __name__ == "__main__":
+  import os
   import sys
   t = "12:00" if len(sys.argv) < 2 else sys.argv[1]
   h,m = (int(x) for x in t.split(':', maxsplit=1))
@@ -88,12 +462,15 @@ if __name__ == "__main__":
 
   logging.basicConfig(level=logging.DEBUG)
 
-  p = PirrigatorClient('http://pirrigator:5000/api')
+  cache_dir = os.path.expanduser('~/.cache')
+  os.makedirs(cache_dir, exist_ok=True)
+  p = PirrigatorClient('http://pirrigator:5000/api', cache=HistoryCache(os.path.join(cache_dir, 'pirrigator.db')))
   hour = timedelta(seconds=3600)
-  print(p.weather_history(time - hour, time + hour).at(time))
+  history = p.history(time - hour, time + hour)
+  print(history.weather.at(time))
 
-  for s in p.moisture_sensors():
-    print(s, p.moisture_history(s, time - hour, time + hour).at(time))
+  for s, series in history.moisture.items():
+    print(s, series.at(time))
 
-  for z in p.zones():
-    print(z, p.irrigation_history(s, time - hour, time + hour))
+  for z, series in history.irrigation.items():
+    print(z, series)
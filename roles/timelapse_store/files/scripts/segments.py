@@ -0,0 +1,352 @@
+import argparse
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from frame_manifest import FrameManifest, capture_time, ENCODED
+from overlay_pirrigator_data import ImageFile, FRAME_DURATION, MIN_BRIGHTNESS
+from PIL import Image
+from run_report import RunReport
+from typing import List
+from video_writer import VideoWriter, RENDITIONS, rendition_path
+
+
+_PNG_FORMAT = re.compile(r'img\d{10}.png')
+_MANIFEST = 'manifest.json'
+_LOCK = 'manifest.lock'
+
+# How long after the end of an hour to wait before treating it as closed
+_CLOSE_MARGIN = timedelta(minutes=10)
+
+# Removed days are remembered for this long, so that a composite image
+# still on disk after its day's segments were removed is never encoded
+_REMOVED_MEMORY = timedelta(days=7)
+
+
+def _hour_start(key: str) -> datetime:
+  """
+  Get the start time of the hour 'key' ('YYYYMMDD-HH')
+  """
+  return datetime.strptime(key, '%Y%m%d-%H')
+
+
+def _day_prefix(day: date) -> str:
+  return f'{day:%Y%m%d}'
+
+
+class SegmentStore:
+  """
+  Encodes the composite images in a directory into one H.264 segment per
+  hour, keeping a manifest of the segments already encoded and the frames
+  that went into each. A day's movie is then just a stream copy of its
+  segments joined together. The overlay service and the nightly job share
+  the store, so the manifest is reloaded from disk under a file lock for
+  every change
+  """
+  def __init__(self, images_dir: str, segments_dir: str, frame_rate: float, ffmpeg: str = '/usr/bin/ffmpeg',
+               report: RunReport = None, renditions: List = RENDITIONS, manifest: FrameManifest = None):
+    self._report = report or RunReport()
+    self._frame_manifest = manifest
+    self._renditions = renditions
+    self._images_dir = images_dir
+    self._segments_dir = segments_dir
+    self._frame_rate = frame_rate
+    self._ffmpeg = ffmpeg
+    os.makedirs(segments_dir, exist_ok=True)
+
+    self._manifest_path = os.path.join(segments_dir, _MANIFEST)
+    self._lock_path = os.path.join(segments_dir, _LOCK)
+    self._segments = {}
+    self._removed = []
+
+  @contextmanager
+  def _locked(self):
+    """
+    Hold the manifest lock, with the manifest freshly loaded from disk
+    """
+    with open(self._lock_path, 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        self._load_manifest()
+        yield
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+  def _load_manifest(self):
+    manifest = {}
+    if os.path.isfile(self._manifest_path):
+      with open(self._manifest_path, 'rt') as f:
+        manifest = json.load(f)
+    # Manifests from before segments were keyed by year are dropped
+    self._segments = manifest.get('segments', {})
+    self._removed = manifest.get('removed', [])
+
+  def _save_manifest(self):
+    cutoff = _day_prefix(datetime.now() - _REMOVED_MEMORY)
+    self._removed = [day for day in self._removed if day >= cutoff]
+
+    tmp_path = self._manifest_path + '.tmp'
+    with open(tmp_path, 'wt') as f:
+      json.dump({ 'segments': self._segments, 'removed': self._removed }, f, indent=1)
+    os.replace(tmp_path, self._manifest_path)
+
+  def _frames(self) -> dict:
+    """
+    Get the composite images in the images directory grouped by hour key,
+    as lists of [name, mtime, slots] in date order, where 'slots' is the
+    number of frame times each is shown for. Without a frame manifest this
+    is always one; with one, frames merged into an earlier similar frame
+    are left out and that frame is shown for longer
+    """
+    hours = {}
+    for path in sorted(glob.glob(os.path.join(self._images_dir, 'img*.png'))):
+      name = os.path.basename(path)
+      if _PNG_FORMAT.match(name):
+        mtime = os.path.getmtime(path)
+        slots = self._slots(path)
+        if slots > 0:
+          taken = capture_time(name.replace('.png', '.jpg'), datetime.fromtimestamp(mtime))
+          hours.setdefault(f'{taken:%Y%m%d-%H}', []).append([name, mtime, slots])
+    return hours
+
+  def _slots(self, path: str) -> int:
+    source = path.replace('.png', '.jpg')
+    if self._frame_manifest and os.path.isfile(source):
+      return self._frame_manifest.slots(source)
+    return 1
+
+  def _files(self, name: str) -> List[str]:
+    """
+    Get the paths of the segment 'name' and each of its renditions
+    """
+    path = os.path.join(self._segments_dir, name)
+    return [path] + [rendition_path(path, suffix) for suffix, _, _ in self._renditions]
+
+  def _encoded(self, key: str, frames: List) -> bool:
+    entry = self._segments.get(key)
+    return entry is not None and entry['frames'] == frames and \
+      all(os.path.isfile(path) for path in self._files(entry['file']))
+
+  def _encode(self, key: str, frames: List):
+    """
+    Encode the segment for hour 'key' from 'frames', with the lock held,
+    unless it has already been encoded from exactly those frames or its
+    day has been removed
+    """
+    if self._encoded(key, frames) or key[:8] in self._removed:
+      return
+
+    logging.info(f'Encoding segment {key} from {len(frames)} frames')
+    name = f'seg{key}.mp4'
+    tmp_path = os.path.join(self._segments_dir, f'tmp-{name}')
+    with self._report.stage('encode'), \
+         VideoWriter(tmp_path, self._frame_rate, self._ffmpeg, self._renditions) as video:
+      for frame, _, slots in frames:
+        with Image.open(os.path.join(self._images_dir, frame)) as image:
+          for _ in range(slots):
+            video.write(image)
+    for tmp, path in zip(video.paths(), self._files(name)):
+      os.replace(tmp, path)
+      self._report.count('bytes_written', os.path.getsize(path))
+    self._report.count('segments_encoded')
+
+    self._segments[key] = { 'file': name, 'frames': frames }
+    self._save_manifest()
+
+  def encode(self, key: str, frames: List):
+    """
+    Encode the segment for hour 'key' from 'frames', unless it has already
+    been encoded from exactly those frames
+    """
+    with self._locked():
+      self._encode(key, frames)
+
+  def encode_closed(self, now: datetime):
+    """
+    Encode every hour which ended long enough before 'now' that no more
+    frames are expected for it
+    """
+    for key, frames in self._frames().items():
+      if _hour_start(key) + timedelta(hours=1) + _CLOSE_MARGIN <= now:
+        self.encode(key, frames)
+
+  def concat(self, day: date, output: str) -> int:
+    """
+    Encode any remaining segments for 'day' and join them all into
+    'output', and each rendition alongside it, without re-encoding.
+    Returns the number of segments joined
+    """
+    prefix = _day_prefix(day)
+    with self._locked():
+      for key, frames in self._frames().items():
+        if key.startswith(prefix):
+          self._encode(key, frames)
+
+      keys = sorted(k for k in self._segments.keys() if k.startswith(prefix))
+      if not keys:
+        return 0
+
+      outputs = [('', output)] + [(suffix, rendition_path(output, suffix)) for suffix, _, _ in self._renditions]
+      index = os.path.join(self._segments_dir, f'{prefix}.txt')
+      for suffix, path in outputs:
+        with open(index, 'wt') as f:
+          for key in keys:
+            f.write(f"file '{rendition_path(self._segments[key]['file'], suffix)}'\n")
+
+        with self._report.stage('concat'):
+          subprocess.run([
+            self._ffmpeg,
+            '-loglevel', 'error',
+            '-y',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', index,
+            '-c', 'copy',
+            '-movflags', 'faststart',
+            path
+          ], check=True)
+        self._report.count('bytes_written', os.path.getsize(path))
+      os.remove(index)
+
+    self._report.count('segments_joined', len(keys))
+    return len(keys)
+
+  def sources(self, day: date) -> List[str]:
+    """
+    Get the paths of the source images which went into the segments for
+    'day' and are still present
+    """
+    prefix = _day_prefix(day)
+    with self._locked():
+      paths = [
+        os.path.join(self._images_dir, name.replace('.png', '.jpg'))
+        for key in sorted(self._segments.keys()) if key.startswith(prefix)
+        for name, *_ in self._segments[key]['frames']
+      ]
+    return [p for p in paths if os.path.isfile(p)]
+
+  def removed(self, day: date) -> bool:
+    """
+    Whether the segments for 'day' have been joined and removed already
+    """
+    with self._locked():
+      return _day_prefix(day) in self._removed
+
+  def remove(self, day: date):
+    """
+    Delete the segments for 'day' once they are no longer needed, and
+    remember that the day is finished so none of its images are encoded
+    again
+    """
+    prefix = _day_prefix(day)
+    with self._locked():
+      for key in [k for k in self._segments.keys() if k.startswith(prefix)]:
+        for path in self._files(self._segments.pop(key)['file']):
+          if os.path.isfile(path):
+            os.remove(path)
+      if prefix not in self._removed:
+        self._removed.append(prefix)
+      self._save_manifest()
+
+
+def _dark_day(manifest: FrameManifest, day: date) -> bool:
+  """
+  Whether every frame of 'day' in 'manifest' is too dark to be shown, so
+  the day has no segments and never will
+  """
+  start = datetime.combine(day, datetime.min.time())
+  frames = [path for path, _ in manifest.frames(start, start + timedelta(days=1)) if os.path.isfile(path)]
+  return len(frames) > 0 and all(manifest.brightness(ImageFile(path)) <= MIN_BRIGHTNESS for path in frames)
+
+
+def parse_command_line_args():
+  """
+  Parse the command line arguments. Returns the args object
+  """
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    'output',
+    metavar='PATH',
+    type=str,
+    nargs='?',
+    help='Video file to write, with a smaller rendition alongside it for each of '
+         + ', '.join(suffix for suffix, _, _ in RENDITIONS) + '; leave out to only --remove'
+  )
+
+  parser.add_argument(
+    '--images',
+    action='store',
+    required=True,
+    help='Directory holding the composite images'
+  )
+
+  parser.add_argument(
+    '--segments',
+    action='store',
+    help='Directory holding the encoded segments, by default "segments" in the images directory'
+  )
+
+  parser.add_argument(
+    '--day',
+    action='store',
+    type=date.fromisoformat,
+    required=True,
+    help='Day to join the segments for, as YYYY-MM-DD'
+  )
+
+  parser.add_argument(
+    '--report',
+    action='store',
+    help='Add a JSON report of the time taken by each stage to this file'
+  )
+
+  parser.add_argument(
+    '--manifest',
+    action='store',
+    help='Path to a manifest giving how long to show each image, in which to '
+         'mark the day\'s images as encoded'
+  )
+
+  parser.add_argument(
+    '--remove',
+    action='store_true',
+    help='Delete the day\'s segments once they have been joined'
+  )
+
+  args = parser.parse_args()
+  if not args.output and not args.remove:
+    parser.error('give a video file to write, or --remove')
+  return args
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  args = parse_command_line_args()
+  report = RunReport()
+  segments_dir = args.segments or os.path.join(args.images, 'segments')
+  manifest = FrameManifest(args.manifest) if args.manifest else None
+  store = SegmentStore(args.images, segments_dir, 1 / FRAME_DURATION, report=report, manifest=manifest)
+  try:
+    if args.output and store.concat(args.day, args.output) == 0:
+      if store.removed(args.day):
+        logging.info(f'Segments for {args.day} were already joined and removed')
+      elif manifest and _dark_day(manifest, args.day):
+        logging.info(f'No images bright enough for {args.day}; no movie to make')
+      else:
+        logging.error(f'No segments for {args.day}')
+        sys.exit(1)
+  finally:
+    if args.report:
+      report.write(args.report, 'segments')
+  if manifest and args.output:
+    for path in store.sources(args.day):
+      manifest.mark(path, ENCODED)
+  if args.remove:
+    store.remove(args.day)
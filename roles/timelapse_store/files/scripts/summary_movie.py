@@ -0,0 +1,174 @@
+import argparse
+import logging
+import os
+from archive import FrameArchive
+from datetime import date, datetime, timedelta
+from history_cache import HistoryCache
+from overlay_pirrigator_data import OverlayData, image_renderer, render_frame
+from pirrigator_client import PirrigatorClient, NEAREST, PREVIOUS, LINEAR
+from run_report import RunReport
+from typing import List, Tuple
+from video_writer import VideoWriter, RENDITIONS
+
+
+WEEK = 'week'
+MONTH = 'month'
+SEASON = 'season'
+
+# The growing season starts on this (month, day)
+_SEASON_START = (3, 1)
+
+# Summaries play faster than the daily movies, and are capped at this many
+# frames so even a whole season takes bounded time to render
+_FRAME_RATE = 12
+_MAX_FRAMES = 1500
+
+
+def period_range(period: str, last_day: date) -> Tuple[datetime, datetime]:
+  """
+  Get the start and end times of the summary 'period' ending with 'last_day'.
+  A month is the calendar month so far, and a season runs from the start of
+  the growing season in the same year
+  """
+  end = datetime.combine(last_day + timedelta(days=1), datetime.min.time())
+  if period == WEEK:
+    start = end - timedelta(days=7)
+  elif period == MONTH:
+    start = datetime(last_day.year, last_day.month, 1)
+  elif period == SEASON:
+    start = datetime(last_day.year, *_SEASON_START)
+  else:
+    raise ValueError(f'unknown summary period {period}')
+  return start, end
+
+
+def spread(frames: List, limit: int) -> List:
+  """
+  Pick at most 'limit' of 'frames', evenly spaced through them
+  """
+  if len(frames) <= limit:
+    return frames
+  return [frames[i * len(frames) // limit] for i in range(limit)]
+
+
+def parse_command_line_args():
+  """
+  Parse the command line arguments. Returns the args object
+  """
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    'archive',
+    metavar='DIR',
+    type=str,
+    help='Archive directory'
+  )
+
+  parser.add_argument(
+    'output',
+    metavar='PATH',
+    type=str,
+    help='Video file to write, with a smaller rendition alongside it for each of '
+         + ', '.join(suffix for suffix, _, _ in RENDITIONS)
+  )
+
+  parser.add_argument(
+    '--period',
+    action='store',
+    choices=[WEEK, MONTH, SEASON],
+    default=WEEK,
+    help='Length of the summary'
+  )
+
+  parser.add_argument(
+    '--last-day',
+    action='store',
+    type=date.fromisoformat,
+    default=date.today() - timedelta(days=1),
+    help='Last day of the summary, as YYYY-MM-DD; by default yesterday'
+  )
+
+  parser.add_argument(
+    '--pirrigator',
+    action='store',
+    default='http://pirrigator:5000/api',
+    help='Base URL for Pirrigator API'
+  )
+
+  parser.add_argument(
+    '--cache',
+    action='store',
+    help='Path to a local database to cache Pirrigator history in'
+  )
+
+  parser.add_argument(
+    '--sampling',
+    action='store',
+    choices=[NEAREST, PREVIOUS, LINEAR],
+    default=NEAREST,
+    help='How to sample the Pirrigator data at each image time'
+  )
+
+  parser.add_argument(
+    '--max-frames',
+    action='store',
+    type=int,
+    default=_MAX_FRAMES,
+    help='Most frames to put in the summary'
+  )
+
+  parser.add_argument(
+    '--workers',
+    action='store',
+    type=int,
+    default=1,
+    help='Number of processes to render images in parallel'
+  )
+
+  parser.add_argument(
+    '--report',
+    action='store',
+    help='Add a JSON report of the time taken by each stage to this file'
+  )
+
+  return parser.parse_args()
+
+
+def run(args, report: RunReport):
+  """
+  Make the summary movie described by the command line
+  """
+  start, end = period_range(args.period, args.last_day)
+  frames = spread(FrameArchive(args.archive).frames(start, end), args.max_frames)
+  report.count('images', len(frames))
+  if not frames:
+    logging.warning(f'No archived images for the {args.period} from {start:%Y-%m-%d}')
+    return
+  logging.info(f'Making {args.period} summary from {len(frames)} images')
+
+  # One ranged fetch covers every frame in the summary
+  with report.stage('fetch'):
+    history_cache = HistoryCache(args.cache) if args.cache else None
+    client = PirrigatorClient(args.pirrigator, cache=history_cache, on_request=report.add_request)
+    data = OverlayData(client, frames[0][1], frames[-1][1] + timedelta(minutes=10),
+                       (taken for _, taken in frames), args.sampling)
+
+  with report.stage('render'), \
+       image_renderer(data, args.workers, in_flight=2 * args.workers) as render, \
+       VideoWriter(args.output, _FRAME_RATE, renditions=RENDITIONS) as video:
+    for frame, stats, _ in render(render_frame, ((path, False) for path, _ in frames)):
+      video.write(frame)
+      report.add_frame(stats)
+  for path in video.paths():
+    report.count('bytes_written', os.path.getsize(path))
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  args = parse_command_line_args()
+  report = RunReport()
+  try:
+    run(args, report)
+  finally:
+    if args.report:
+      report.write(args.report, f'summary_{args.period}')
@@ -0,0 +1,109 @@
+import logging
+import os
+from PIL import Image
+
+
+_TILE_WIDTH = 160
+_COLUMNS = 10
+_ROWS = 10
+_POSTER_WIDTH = 1280
+_QUALITY = 75
+
+
+def thumbnail(image: Image, width: int = _TILE_WIDTH) -> Image:
+  """
+  Scale 'image' down to 'width' pixels wide for a sprite sheet tile
+  """
+  height = round(image.height * width / image.width)
+  return image.convert('RGB').resize((width, height), Image.BILINEAR, reducing_gap=2.0)
+
+
+def draft_thumbnail(path: str, width: int = _TILE_WIDTH) -> Image:
+  """
+  Make a sprite sheet tile straight from the image file at 'path'. For a
+  JPEG a reduced scale decode is used, so the full image is never decoded
+  """
+  with Image.open(path) as image:
+    image.draft('RGB', (width, round(image.height * width / image.width)))
+    return thumbnail(image, width)
+
+
+def _timestamp(secs: float) -> str:
+  ms = round(secs * 1000)
+  return f'{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}'
+
+
+class SpriteSheets:
+  """
+  Collects a thumbnail of each frame of a video into grids of tiles saved
+  as JPEG sprite sheets, with a WebVTT track giving the tile for each
+  moment of the video, so a player can show where it would scrub to
+  without fetching the video. Everything is written next to 'prefix',
+  which is the video path without its extension
+  """
+  def __init__(self, prefix: str, frame_duration: float, columns: int = _COLUMNS, rows: int = _ROWS):
+    self._prefix = prefix
+    self._frame_duration = frame_duration
+    self._columns = columns
+    self._rows = rows
+    self._sheet = None
+    self._sheets = 0
+    self._time = 0.0
+    self._cues = []
+    self.paths = []
+
+  def _sheet_name(self) -> str:
+    return f'{os.path.basename(self._prefix)}-sprites-{self._sheets}.jpg'
+
+  def _save_sheet(self):
+    if self._sheet is not None:
+      # The last sheet is cropped to the rows used
+      tiles = len(self._cues) - self._sheets * self._columns * self._rows
+      rows = -(-tiles // self._columns)
+      tile_height = self._sheet.height // self._rows
+      path = os.path.join(os.path.dirname(self._prefix), self._sheet_name())
+      self._sheet.crop((0, 0, self._sheet.width, rows * tile_height)).save(path, quality=_QUALITY)
+      self.paths.append(path)
+      self._sheet = None
+      self._sheets += 1
+
+  def add(self, tile: Image, slots: int = 1):
+    """
+    Add the thumbnail for the next frame, which is shown for 'slots' frame
+    times
+    """
+    n = len(self._cues) % (self._columns * self._rows)
+    if n == 0:
+      self._save_sheet()
+      self._sheet = Image.new('RGB', (tile.width * self._columns, tile.height * self._rows))
+
+    x = (n % self._columns) * tile.width
+    y = (n // self._columns) * tile.height
+    self._sheet.paste(tile, (x, y))
+
+    end = self._time + slots * self._frame_duration
+    self._cues.append(
+      f'{_timestamp(self._time)} --> {_timestamp(end)}\n'
+      f'{self._sheet_name()}#xywh={x},{y},{tile.width},{tile.height}\n'
+    )
+    self._time = end
+
+  def poster(self, image: Image):
+    """
+    Save 'image' as the poster shown before the video plays
+    """
+    path = f'{self._prefix}-poster.jpg'
+    thumbnail(image, min(_POSTER_WIDTH, image.width)).save(path, quality=_QUALITY)
+    self.paths.append(path)
+
+  def close(self):
+    """
+    Save the last sprite sheet and write the WebVTT track
+    """
+    self._save_sheet()
+    path = f'{self._prefix}-thumbnails.vtt'
+    with open(path, 'wt') as f:
+      f.write('WEBVTT\n\n')
+      f.write('\n'.join(self._cues))
+    self.paths.append(path)
+    logging.info(f'Wrote {len(self._cues)} thumbnails to {self._sheets} sprite sheets')
@@ -3,36 +3,75 @@ set -e
 
 DIR=$1
 WWW=${2:-/var/www/media}
+DAY=$3
 
 if [ ! -d "${DIR}" ]; then
-	echo "usage: $0 <directory>"
+	echo "usage: $0 <directory> [<www directory> [<YYYY-MM-DD>]]"
 	exit 1
 fi
 
-# runs after midnight so pick image files from day before
-TODAY=`date --date yesterday +%m%d`
-TODAY_LONG=`date --date yesterday "+%B %d"`
+MANIFEST=${DIR}/manifest.db
 
-GLOB=${DIR}/img*.jpg
-LIST=${TODAY}.txt
+# runs after midnight, so with no day given make a movie for every earlier
+# day with images left, which is yesterday plus any night that failed. Each
+# day runs separately so one failure doesn't hold up the others, and only a
+# successful run deletes its images
+if [ -z "${DAY}" ]; then
+	STATUS=0
+	for DAY in `python frame_manifest.py ${MANIFEST} --days --before $(date +%F)`; do
+		bash $0 ${DIR} ${WWW} ${DAY} || STATUS=1
+	done
+	exit ${STATUS}
+fi
+
+# the day comes from the manifest with its year, so December's images are
+# still found and named correctly when processed in January
+TODAY=`date --date ${DAY} +%m%d`
+TODAY_LONG=`date --date ${DAY} "+%B %d"`
+NEXT=`date --date "${DAY} + 1 day" +%F`
+
+GLOB=${DIR}/img${TODAY}*.jpg
+REPORT=${WWW}/${TODAY}.json
 
+# a movie left from a run which failed part way, or from the same day a
+# year ago, mustn't be published as this day's
+rm -f ${REPORT} ${WWW}/${TODAY}.mp4 ${WWW}/${TODAY}-*.mp4
+
+# render any images the overlay service missed; the manifest means a rerun
+# after a failure only redoes images which are missing or have changed
 python overlay_pirrigator_data.py \
 	--pirrigator http://pirrigator:5000/api \
-	--index ${LIST} \
-	${GLOB}
-
-/usr/bin/ffmpeg \
-	-f concat \
-	-safe 0 \
-	-i ${LIST} \
-	-c:v libx264 \
-	-pix_fmt yuv420p \
-	-movflags faststart \
+	--cache ${DIR}/pirrigator.db \
+	--manifest ${MANIFEST} \
+	--merge-similar 10 \
+	--sampling linear \
+	--from ${DAY} \
+	--to ${NEXT} \
+	--thumbnails ${WWW}/${TODAY} \
+	--report ${REPORT} \
+	--workers `nproc`
+
+# keep the brightest image of each hour for the summary movies
+python archive.py ${DIR}/archive \
+	--manifest ${MANIFEST} \
+	--from ${DAY} \
+	--to ${NEXT}
+
+# encode any hours not already encoded and join them all, at full size
+# and in each smaller rendition; a day with no images bright enough has
+# nothing to join, so makes no movie
+python segments.py \
+	--images ${DIR} \
+	--segments ${DIR}/segments \
+	--day ${DAY} \
+	--report ${REPORT} \
+	--manifest ${MANIFEST} \
 	${WWW}/${TODAY}.mp4
 
-rm -f ${LIST} ${GLOB} ${DIR}/*.png
+rm -f ${GLOB} ${DIR}/img${TODAY}*.png
 
-cat <<EOF >${WWW}/${TODAY}.html
+if [ -f ${WWW}/${TODAY}.mp4 ]; then
+	cat <<EOF >${WWW}/${TODAY}.html
 <!doctype html>
 <html>
   <head>
@@ -60,19 +99,102 @@ video {
     right: 0;
     z-index:999;
 }
+
+#scrub {
+    width: 100%;
+}
+
+#preview {
+    display: none;
+    margin: 0 auto;
+}
     </style>
   </head>
   <body>
     <div class="video-container">
-      <video src="${TODAY}.mp4" controls>
+      <video controls preload="none" poster="${TODAY}-poster.jpg">
+        <source src="${TODAY}-mobile.mp4" type="video/mp4" media="(max-width: 640px)">
+        <source src="${TODAY}-720p.mp4" type="video/mp4" media="(max-width: 1280px)">
+        <source src="${TODAY}.mp4" type="video/mp4">
+        <track kind="metadata" label="thumbnails" src="${TODAY}-thumbnails.vtt">
         Your browser does not support HTML5 video
-      </video>"
+      </video>
+      <input id="scrub" type="range" min="0" max="1000" value="0">
+      <div id="preview"></div>
     </div>
+    <script>
+// scrub through the thumbnail sprites without loading the video, and
+// only seek the video when the slider is let go
+var video = document.querySelector('video');
+var track = video.textTracks[0];
+var scrub = document.getElementById('scrub');
+var preview = document.getElementById('preview');
+var time = 0;
+track.mode = 'hidden';
+
+scrub.oninput = function() {
+  var cues = track.cues;
+  if (!cues || cues.length == 0) return;
+  time = scrub.value / 1000 * cues[cues.length - 1].endTime;
+  for (var i = 0; i < cues.length; i++) {
+    if (cues[i].startTime <= time && time < cues[i].endTime) {
+      var parts = cues[i].text.split('#xywh=');
+      var xywh = parts[1].split(',');
+      preview.style.display = 'block';
+      preview.style.backgroundImage = 'url(' + parts[0] + ')';
+      preview.style.backgroundPosition = '-' + xywh[0] + 'px -' + xywh[1] + 'px';
+      preview.style.width = xywh[2] + 'px';
+      preview.style.height = xywh[3] + 'px';
+      break;
+    }
+  }
+};
+
+scrub.onchange = function() {
+  preview.style.display = 'none';
+  video.currentTime = time;
+};
+    </script>
   </body>
 </html>
 EOF
 
-python pushover.py \
-	"Greenhouse" \
-	"Greenhouse timelapse for ${TODAY_LONG}" \
-	https://neilgall.uk:41423/media/${TODAY}.html
+	python pushover.py \
+		"Greenhouse" \
+		"Greenhouse timelapse for ${TODAY_LONG}" \
+		https://neilgall.uk:41423/media/${TODAY}.html
+fi
+
+# only now that everything else for the day has worked are its segments
+# deleted, so a rerun after a failure can still join them
+python segments.py \
+	--images ${DIR} \
+	--segments ${DIR}/segments \
+	--day ${DAY} \
+	--remove
+
+summary() {
+	python summary_movie.py ${DIR}/archive ${WWW}/$2.mp4 \
+		--period $1 \
+		--last-day ${DAY} \
+		--pirrigator http://pirrigator:5000/api \
+		--cache ${DIR}/pirrigator.db \
+		--sampling linear \
+		--workers `nproc` \
+		--report ${WWW}/$2.json
+
+	python pushover.py \
+		"Greenhouse" \
+		"Greenhouse $1 timelapse to ${TODAY_LONG}" \
+		https://neilgall.uk:41423/media/$2.mp4
+}
+
+# summaries of the week and the season so far on Sundays, and of the month
+# on its last day
+if [ `date --date ${DAY} +%u` = 7 ]; then
+	summary week week-${DAY}
+	summary season season-`date --date ${DAY} +%Y`
+fi
+if [ `date --date ${NEXT} +%d` = 01 ]; then
+	summary month month-`date --date ${DAY} +%Y-%m`
+fi
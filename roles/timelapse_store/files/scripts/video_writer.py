@@ -0,0 +1,117 @@
+import logging
+import os
+import subprocess
+from PIL import Image
+from typing import List, Tuple
+
+
+# Smaller renditions encoded alongside the full size video, as file name
+# suffix, maximum frame height and x264 quality (CRF)
+RENDITIONS = [
+  ('-720p', 720, 23),
+  ('-mobile', 360, 28),
+]
+
+
+def rendition_path(path: str, suffix: str) -> str:
+  """
+  Get the path of the rendition of the video at 'path' with 'suffix'
+  """
+  root, ext = os.path.splitext(path)
+  return root + suffix + ext
+
+
+class VideoWriter:
+  """
+  Encodes a sequence of images into a video by piping raw RGB frames into
+  an ffmpeg process. ffmpeg is started when the first frame arrives, and
+  every frame is encoded at the size of the first. Each of 'renditions'
+  is encoded from the same frames by the same ffmpeg process, scaled down
+  to its height, so the frames are only produced and piped once
+  """
+  def __init__(self, path: str, frame_rate: float, ffmpeg: str = '/usr/bin/ffmpeg',
+               renditions: List[Tuple[str, int, int]] = ()):
+    self._path = path
+    self._renditions = renditions
+    self._frame_rate = frame_rate
+    self._ffmpeg = ffmpeg
+    self._process = None
+    self._size = None
+    self.frames = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *args):
+    if exc_type is None:
+      self.close()
+    elif self._process is not None:
+      self._process.kill()
+      self._process.wait()
+
+  def _start(self, size):
+    self._size = size
+    command = [
+      self._ffmpeg,
+      '-loglevel', 'error',
+      '-y',
+      '-f', 'rawvideo',
+      '-pix_fmt', 'rgb24',
+      '-s', f'{size[0]}x{size[1]}',
+      '-framerate', str(self._frame_rate),
+      '-i', '-',
+    ]
+
+    if not self._renditions:
+      outputs = [('0:v', self._path, 23)]
+    else:
+      # Split the input once and scale a copy for each rendition
+      splits = ''.join(f'[s{n}]' for n in range(len(self._renditions)))
+      filters = [f'[0:v]split={len(self._renditions) + 1}[full]{splits}']
+      outputs = [('[full]', self._path, 23)]
+      for n, (suffix, height, crf) in enumerate(self._renditions):
+        filters.append(f"[s{n}]scale=-2:'min({height},ih)'[r{n}]")
+        outputs.append((f'[r{n}]', rendition_path(self._path, suffix), crf))
+      command += ['-filter_complex', ';'.join(filters)]
+
+    for stream, path, crf in outputs:
+      command += [
+        '-map', stream,
+        '-c:v', 'libx264',
+        '-crf', str(crf),
+        '-pix_fmt', 'yuv420p',
+        '-movflags', 'faststart',
+        path
+      ]
+
+    logging.debug(' '.join(command))
+    self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+  def paths(self) -> List[str]:
+    """
+    The paths of all the videos written, full size first
+    """
+    return [self._path] + [rendition_path(self._path, suffix) for suffix, _, _ in self._renditions]
+
+  def write(self, image: Image):
+    """
+    Append 'image' to the video
+    """
+    if self._process is None:
+      self._start(image.size)
+    if image.mode != 'RGB':
+      image = image.convert('RGB')
+    if image.size != self._size:
+      image = image.resize(self._size)
+    self._process.stdin.write(image.tobytes())
+    self.frames += 1
+
+  def close(self):
+    """
+    Finish encoding and wait for ffmpeg to exit
+    """
+    if self._process is not None:
+      self._process.stdin.close()
+      if self._process.wait() != 0:
+        raise RuntimeError(f'ffmpeg failed with exit status {self._process.returncode}')
+      self._process = None
@@ -1,4 +1,6 @@
 import logging
+import threading
+import time
 
 logger = logging.getLogger("WindowController")
 logger.setLevel(logging.INFO)
@@ -10,7 +12,6 @@ logger.addHandler(streamHandler)
 
 try:
   import RPi.GPIO as gpio
-  import time
 
   OPEN_WINDOWS_PIN = 23
   CLOSE_WINDOWS_PIN = 24
@@ -54,3 +55,93 @@ except:
 
     def close_windows(self):
       logger.info("close")
+
+
+class WindowActuator:
+  """
+  Drives a WindowController from its own thread so callers never wait for
+  a button press. Only the most recently requested state matters, so a
+  request replaces any earlier one not yet acted on. Button presses are
+  kept at least 'min_spacing' seconds apart
+  """
+  def __init__(self, controller, min_spacing=2.0):
+    self._controller = controller
+    self._min_spacing = min_spacing
+    self._condition = threading.Condition()
+    self._pending = None
+    self._stopping = False
+    self._last_press = 0.0
+    self._thread = threading.Thread(target=self._run, name="WindowActuator", daemon=True)
+    self._thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def request(self, open_windows, on_done=None):
+    """
+    Ask for the windows to be opened or closed. 'on_done' is called with
+    the state and the time the button press finished, unless the request
+    is superseded first
+    """
+    with self._condition:
+      if self._pending is not None:
+        logger.info("superseding pending request")
+      self._pending = (open_windows, on_done)
+      self._condition.notify()
+
+  def close(self):
+    """
+    Carry out any pending request and stop the actuator thread
+    """
+    with self._condition:
+      self._stopping = True
+      self._condition.notify()
+    self._thread.join()
+
+  def _next(self):
+    """
+    Wait for a request and for the minimum spacing since the last press,
+    then take whichever request is latest
+    """
+    with self._condition:
+      while self._pending is None:
+        if self._stopping:
+          return None
+        self._condition.wait()
+
+      while True:
+        wait = self._last_press + self._min_spacing - time.monotonic()
+        if wait <= 0:
+          break
+        self._condition.wait(wait)
+
+      request = self._pending
+      self._pending = None
+      return request
+
+  def _run(self):
+    while True:
+      request = self._next()
+      if request is None:
+        return
+
+      open_windows, on_done = request
+      try:
+        if open_windows:
+          self._controller.open_windows()
+        else:
+          self._controller.close_windows()
+      except Exception:
+        logger.exception("failed to operate windows")
+        continue
+      finally:
+        self._last_press = time.monotonic()
+
+      if on_done:
+        try:
+          on_done(open_windows, time.time())
+        except Exception:
+          logger.exception("request completion callback failed")
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
-from fresh_air import WindowController
+from fresh_air import WindowActuator, WindowController
+from metrics import HealthServer, Metrics
 import logging
 import json
 import pushover
+import signal
+import threading
 import time
 
 
@@ -12,6 +14,9 @@ port = 443
 rootCAPath = "./root-CA.crt"
 thingName = "fresh-air"
 clientId = "fresh-air-buttons"
+healthPort = 8765
+metricsPath = "./metrics.json"
+metricsInterval = 600
 
 logger = logging.getLogger("AWSIoTPythonSDK.core")
 logger.setLevel(logging.INFO)
@@ -21,41 +26,98 @@ streamHandler.setFormatter(formatter)
 logger.addHandler(streamHandler)
 
 
-def create_iot():
+def create_iot(metrics):
+    # Imported here so the shadow handler can be used without the SDK
+    from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
+
     iot = AWSIoTMQTTShadowClient(clientId, useWebsocket=True)
     iot.configureEndpoint(host, port)
     iot.configureCredentials(rootCAPath)
     iot.configureAutoReconnectBackoffTime(1, 32, 20)
     iot.configureConnectDisconnectTimeout(10) 
     iot.configureMQTTOperationTimeout(5)
+
+    mqtt = iot.getMQTTConnection()
+    mqtt.onOnline = lambda: metrics.set("online", True)
+    mqtt.onOffline = lambda: metrics.set("online", False)
+
     iot.connect()
+    metrics.set("online", True)
     return iot
 
 
-def create_shadow_handler(iot, callback):
+def create_shadow_handler(iot, actuator, metrics, callback):
+    """
+    Handle shadow deltas by operating the windows, reporting the new state
+    back once done and calling 'callback(state, on_sent)'. The latency of
+    each stage from the shadow change to the notification is recorded in
+    'metrics'
+    """
     shadow = iot.createShadowHandlerWithName(thingName, True)
 
     def on_delta(payload, responseStatus, token):
+        received = time.time()
         print(payload)
-        state = json.loads(payload)["state"].get("state")
+        metrics.increment("deltas")
+        delta = json.loads(payload)
+        changed = delta.get("timestamp")
+        if changed is not None:
+            metrics.latency.record("shadow_to_callback", received - changed)
+
+        def on_acknowledged(actuated, payload, responseStatus, token):
+            if responseStatus == "accepted":
+                metrics.latency.record("actuated_to_acknowledged", time.time() - actuated)
+            else:
+                metrics.increment("updates_" + str(responseStatus))
+
+        def on_sent(actuated, sent):
+            metrics.latency.record("actuated_to_notified", sent - actuated)
+            if changed is not None:
+                metrics.latency.record("shadow_to_notified", sent - changed)
+
+        def on_done(state, actuated):
+            metrics.increment("actuations")
+            metrics.latency.record("callback_to_actuated", actuated - received)
+            if changed is not None:
+                metrics.latency.record("shadow_to_actuated", actuated - changed)
+
+            reported = { "state": "ON" if state else "OFF", "completed": int(actuated) }
+            shadow.shadowUpdate(json.dumps({ "state": { "reported": reported } }),
+                                lambda *args: on_acknowledged(actuated, *args), 5)
+            callback(state, lambda sent: on_sent(actuated, sent))
+
+        state = delta["state"].get("state")
         if state is not None:
-            callback(state == "ON")
-            shadow.shadowUpdate(json.dumps({ "state": { "reported": { "state": state } } }), None, 5)
+            actuator.request(state == "ON", on_done)
 
     shadow.shadowRegisterDeltaCallback(on_delta)
 
 
 if __name__ == "__main__":
-    with WindowController() as window_controller:
-        def callback(state):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+    metrics = Metrics()
+
+    with WindowController() as window_controller, \
+         WindowActuator(window_controller) as actuator, \
+         pushover.Notifier() as notifier, \
+         HealthServer(metrics, healthPort, lambda: metrics.get("online", False)):
+        def callback(state, on_sent):
             if state:
-                window_controller.open_windows()
-                pushover.send("Fresh Air", "Windows opened!")
+                notifier.notify("Fresh Air", "Windows opened!", on_sent=on_sent)
             else:
-                window_controller.close_windows()
-                pushover.send("Fresh Air", "Windows closed!")
-        
-        create_shadow_handler(create_iot(), callback)
+                notifier.notify("Fresh Air", "Windows closed!", on_sent=on_sent)
+
+        iot = create_iot(metrics)
+        create_shadow_handler(iot, actuator, metrics, callback)
+
+        # Nothing to do here but report the metrics now and then until asked
+        # to stop; everything else happens on the IoT SDK's threads
+        while not stop.wait(metricsInterval):
+            metrics.dump(metricsPath)
 
-        while True:
-            time.sleep(1)
+        logger.info("shutting down")
+        metrics.dump(metricsPath)
+        iot.disconnect()
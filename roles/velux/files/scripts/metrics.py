@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("Metrics")
+
+
+class LatencyHistogram:
+    """
+    Keeps the most recent 'window' latency samples for each named stage
+    and summarises them as percentiles
+    """
+    def __init__(self, window=500):
+        self._lock = threading.Lock()
+        self._window = window
+        self._samples = {}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self._window)).append(seconds)
+
+    def summary(self):
+        with self._lock:
+            samples = { stage: sorted(s) for stage, s in self._samples.items() }
+
+        def percentile(s, p):
+            return s[min(int(len(s) * p / 100), len(s) - 1)]
+
+        return {
+            stage: {
+                "count": len(s),
+                "p50": percentile(s, 50),
+                "p95": percentile(s, 95),
+                "p99": percentile(s, 99),
+                "max": s[-1]
+            }
+            for stage, s in samples.items()
+        }
+
+
+class Metrics:
+    """
+    Thread-safe counters, values and latencies describing the running service
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._counters = {}
+        self._values = {}
+        self.latency = LatencyHistogram()
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name, default=None):
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "uptime": time.time() - self._started,
+                "counters": dict(self._counters),
+                "values": dict(self._values)
+            }
+        snapshot["latency"] = self.latency.summary()
+        return snapshot
+
+    def dump(self, path=None):
+        """
+        Log the latency summary and, if given a 'path', write the whole
+        snapshot there as JSON
+        """
+        snapshot = self.snapshot()
+        for stage, summary in sorted(snapshot["latency"].items()):
+            logger.info("%s: n=%d p50=%.3fs p95=%.3fs p99=%.3fs max=%.3fs", stage,
+                        summary["count"], summary["p50"], summary["p95"], summary["p99"], summary["max"])
+        if path:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wt") as f:
+                json.dump(snapshot, f, indent=1)
+            os.replace(tmp_path, path)
+
+
+class HealthServer:
+    """
+    A tiny local HTTP server reporting liveness at /health and the
+    metrics at /metrics, both as JSON. /health answers 503 unless
+    'healthy()' returns True
+    """
+    def __init__(self, metrics, port, healthy, host="127.0.0.1"):
+        metrics_ = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/health":
+                    ok = healthy()
+                    self._reply(200 if ok else 503, { "status": "ok" if ok else "unhealthy" })
+                elif self.path == "/metrics":
+                    self._reply(200, metrics_.snapshot())
+                else:
+                    self._reply(404, { "status": "not found" })
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="HealthServer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -1,21 +1,181 @@
 #!/usr/bin/env python3
-import requests
+import glob
+import json
+import logging
 import os
+import queue
+import requests
+import threading
+import time
+import uuid
 
 _PUSHOVER_USER_KEY = os.environ.get("PUSHOVER_USER_KEY", "")
 _PUSHOVER_API_TOKEN = os.environ.get("PUSHOVER_API_TOKEN", "")
+_PUSHOVER_URL = os.environ.get("PUSHOVER_URL", "https://api.pushover.net/1/messages.json")
+_SPOOL_DIR = os.environ.get("PUSHOVER_SPOOL_DIR", os.path.expanduser("~/.cache/pushover"))
+_TIMEOUT = 10
+
+logger = logging.getLogger("pushover")
 
-def send(title, message, url=None):
-    rsp = requests.post('https://api.pushover.net/1/messages.json', params={
+
+def send(title, message, url=None, api_url=_PUSHOVER_URL):
+    rsp = requests.post(api_url, params={
         'token': _PUSHOVER_API_TOKEN,
         'user':  _PUSHOVER_USER_KEY,
         'title': title,
         'message': message,
         'sound': 'none',
         'url': url 
-    })
-    return rsp.json() if rsp.status_code < 300 else rsp.status_code
+    }, timeout=_TIMEOUT)
+    return rsp.status_code
+
+
+class Notifier:
+    """
+    Sends Pushover messages from a background thread so callers never wait
+    on the network. Messages with the same title and url queued within
+    'coalesce' seconds of each other are sent as one. Messages which can't
+    be delivered are written to a spool directory and retried every 'retry'
+    seconds, including by later processes, until they are 'max_age' old
+    """
+    def __init__(self, spool_dir=_SPOOL_DIR, api_url=_PUSHOVER_URL, max_queue=100,
+                 coalesce=2.0, retry=60.0, max_age=86400.0):
+        self._spool_dir = spool_dir
+        self._api_url = api_url
+        self._coalesce = coalesce
+        self._retry = retry
+        self._max_age = max_age
+        self._queue = queue.Queue(max_queue)
+        os.makedirs(spool_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="Notifier", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def notify(self, title, message, url=None, on_sent=None):
+        """
+        Queue a message, returning immediately. 'on_sent' is called with the
+        time the message was delivered, if it is delivered by this process.
+        Returns False if the queue is full and the message was dropped
+        """
+        try:
+            self._queue.put_nowait((title, message, url, on_sent))
+            return True
+        except queue.Full:
+            logger.warning("queue full; dropping message %s", title)
+            return False
+
+    def close(self, timeout=None):
+        """
+        Send everything queued so far and stop the background thread.
+        Anything which can't be delivered stays in the spool
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        self._send_spool()
+        next_retry = time.time() + self._retry
+        while True:
+            try:
+                first = self._queue.get(timeout=max(next_retry - time.time(), 0))
+            except queue.Empty:
+                self._send_spool()
+                next_retry = time.time() + self._retry
+                continue
+
+            batch, stop = self._collect(first)
+            for title, url, messages, callbacks in self._group(batch):
+                try:
+                    self._deliver({ 'title': title, 'message': "\n".join(messages), 'url': url,
+                                    'queued': time.time() }, callbacks)
+                except Exception:
+                    logger.exception("failed to deliver %s", title)
+            if stop:
+                return
+
+    def _collect(self, first):
+        """
+        Gather 'first' and any more messages arriving within the coalesce
+        time. Returns the messages and whether a stop was requested
+        """
+        batch = []
+        item = first
+        deadline = time.time() + self._coalesce
+        while item is not None:
+            batch.append(item)
+            try:
+                item = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _group(self, batch):
+        groups = {}
+        for title, message, url, on_sent in batch:
+            messages, callbacks = groups.setdefault((title, url), ([], []))
+            messages.append(message)
+            if on_sent:
+                callbacks.append(on_sent)
+        return [(title, url, messages, callbacks) for (title, url), (messages, callbacks) in groups.items()]
+
+    def _post(self, msg):
+        """
+        Try to deliver 'msg'. Returns False if it should be retried later
+        """
+        try:
+            status = send(msg['title'], msg['message'], msg['url'], self._api_url)
+        except requests.RequestException as e:
+            logger.warning("failed to send %s: %s", msg['title'], e)
+            return False
+        if status >= 300:
+            logger.warning("failed to send %s: status %d", msg['title'], status)
+            return status < 500 and status != 429
+        return True
+
+    def _deliver(self, msg, callbacks):
+        if self._post(msg):
+            sent = time.time()
+            for on_sent in callbacks:
+                on_sent(sent)
+        else:
+            path = os.path.join(self._spool_dir, f"{time.time_ns()}-{uuid.uuid4().hex}.json")
+            with open(path, 'wt') as f:
+                json.dump(msg, f)
+
+    def _send_spool(self):
+        for path in sorted(glob.glob(os.path.join(self._spool_dir, "*.json"))):
+            try:
+                if not self._send_spooled(path):
+                    return
+            except Exception:
+                logger.exception("failed to send spooled message %s", path)
+
+    def _send_spooled(self, path):
+        """
+        Try to deliver the message spooled at 'path'. Returns False if it
+        should be retried later
+        """
+        try:
+            with open(path, 'rt') as f:
+                msg = json.load(f)
+            age = time.time() - msg['queued']
+        except (OSError, ValueError, KeyError):
+            os.remove(path)
+            return True
+        if age > self._max_age:
+            logger.warning("giving up on %s", msg['title'])
+        elif not self._post(msg):
+            return False
+        os.remove(path)
+        return True
+
 
 if __name__ == "__main__":
     import sys
-    send(*sys.argv[1:])
+    with Notifier(coalesce=0) as notifier:
+        notifier.notify(*sys.argv[1:])